@@ -21,41 +21,98 @@ E.g. find a solution for 6 queens, 2 knights, and maximum (2) kings.
 
 """
 import sys
+import numpy as np
 from ortools.sat.python import cp_model
 
+# Variable names only matter when reading a dumped model, so only build them when asked.
+DEBUG_NAMES = False
+
+
+def attack_masks(library: dict, board_size: int) -> dict:
+    """
+    For each piece, a (N², N²) bool array where [src, dst] is True iff
+    the piece standing on square src attacks square dst.
+    Squares are indexed flat, as y * board_size + x.
+    """
+    cells = np.arange(board_size * board_size)
+    xs, ys = cells % board_size, cells // board_size
+    masks = {}
+    for p, moves in library.items():
+        nx = xs[:, None] + moves[:, 0]
+        ny = ys[:, None] + moves[:, 1]
+        on_board = (nx >= 0) & (nx < board_size) & (ny >= 0) & (ny < board_size)  # This clips illegal positions.
+        src, k = on_board.nonzero()
+        mask = np.zeros((board_size * board_size, board_size * board_size), dtype=bool)
+        mask[src, ny[src, k] * board_size + nx[src, k]] = True
+        masks[p] = mask
+    return masks
+
+
+def mirrored(moves, axis: int) -> bool:
+    """
+    True if the set of moves is unchanged when reflected across the given axis
+    (0 flips x, 1 flips y).
+    """
+    flipped = moves.copy()
+    flipped[:, axis] = -flipped[:, axis]
+    return set(map(tuple, moves.tolist())) == set(map(tuple, flipped.tolist()))
+
+
 def chessboard(challenge:dict, library:dict, board_size:int):
     model = cp_model.CpModel()
+    squares = range(board_size * board_size)
 
-    # A dict for each piece in the problem, bool == presence in square of the board.
+    # A list for each piece in the problem, bool == presence in square of the board.
     # using bool over int is always better (as ints are converted to bool anyway)
-    presence = {p: {
-        (x, y): model.NewBoolVar(f"{p}:{x},{y}")
-        for x in range(board_size)
-        for y in range(board_size)
-    } for p in challenge}
-
-    for p, p_moves in presence.items():
-        moves = library[p]
-        for q, q_moves in presence.items():
-            for (x, y), qv in q_moves.items():
-                pv = p_moves[x, y]
-                if p != q:
-                    # No superposition allowed.
-                    # If a p is here, then a q cannot be here.
-                    model.AddImplication(pv, qv.Not())
-                for dx, dy in moves:
-                    nx, ny = x + dx, y + dy
-                    if (nx, ny) in q_moves:  # This clips illegal positions.
-                        model.AddImplication(pv, q_moves[nx, ny].Not())
-
-    maximising = False
+    presence = {p: [
+        model.NewBoolVar(f"{p}:{i % board_size},{i // board_size}" if DEBUG_NAMES else "")
+        for i in squares
+    ] for p in challenge}
+
+    # No superposition allowed: at most one piece on any square.
+    for i in squares:
+        model.AddAtMostOne([presence[p][i] for p in challenge])
+
+    attacks = attack_masks({p: library[p] for p in challenge}, board_size)
+    for p, p_vars in presence.items():
+        # Pull every (src, dst) attack out of the mask in one call, as plain ints per source square.
+        targets = [[] for _ in squares]
+        for src, dst in zip(*(a.tolist() for a in attacks[p].nonzero())):
+            targets[src].append(dst)
+        for i, pv in enumerate(p_vars):
+            # Gather everything a p here attacks, then post it as one clause.
+            excluded = [q_vars[j] for q_vars in presence.values() for j in targets[i]]
+            if excluded:
+                model.AddBoolAnd([v.Not() for v in excluded]).OnlyEnforceIf(pv)
+
+    # Identical pieces share a single grid of Booleans, so they are never permuted.
+    # What remains is the board's own symmetry: when every piece moves the same way
+    # in the mirror, keep only the solutions with at least as many pieces on the
+    # left (top) half as on the right (bottom) half.
+    half = board_size // 2
+    for axis in (0, 1):
+        if all(mirrored(library[p], axis) for p in challenge):
+            near, far = [], []
+            for i in squares:
+                c = (i % board_size, i // board_size)[axis]
+                if c < half:
+                    near.extend(presence[p][i] for p in challenge)
+                elif c >= board_size - half:
+                    far.extend(presence[p][i] for p in challenge)
+            model.Add(sum(near) >= sum(far))
+
+    # Every piece with no requirement joins one objective, rather than each replacing the last.
+    to_maximise = []
     for p,required in challenge.items():
         if required > 0:
-            model.Add(sum(presence[p].values()) == required)
+            model.Add(sum(presence[p]) == required)
         else:
-            model.Add(sum(presence[p].values()) >= 0)
-            model.Maximize(sum((presence[p]).values()))
-            maximising = True
+            to_maximise += presence[p]
+    maximising = bool(to_maximise)
+    if maximising:
+        placed = model.NewIntVar(0, board_size * board_size, 'placed')
+        model.Add(placed == sum(to_maximise))
+        model.Maximize(placed)
     solver = cp_model.CpSolver()
     solver.parameters.max_time_in_seconds = 60
     solver.parameters.num_search_workers = 12
@@ -70,7 +127,7 @@ def chessboard(challenge:dict, library:dict, board_size:int):
         for x in range(board_size):
             for y in range(board_size):
                 for p in challenge:
-                    if solver.Value(presence[p][x,y]):
+                    if solver.Value(presence[p][y * board_size + x]):
                         board[x][y] = p
 
         print()
@@ -98,6 +155,8 @@ def main(board:int):
         '♜': [(0, x) for x in range(1, board)] + [(0, -x) for x in range(1, board)] \
              + [(x, 0) for x in range(1, board)] + [(-x, 0) for x in range(1, board)],
     }
+    # Store the moves as (k, 2) arrays of offsets so attacks can be computed in bulk.
+    library = {p: np.array(moves, dtype=np.int16) for p, moves in library.items()}
     # the problem states how many of each piece must be on the board.
     # one piece may be 0, and then the solver will find the maximum for that piece.
     challenge = {'♚': 0, '♛': 6, '♞': 2}   # two kings.
@@ -27,8 +27,12 @@
     (4) Solves (or fails) for seeking path-lengths from minimum to maximum steps long printing the result.
 """
 
+import numpy as np
 from ortools.sat.python import cp_model
 
+# Variable names only matter when reading a dumped model, so only build them when asked.
+DEBUG_NAMES = False
+
 class DiGraphSolver:
 
     def __init__(self, desc):
@@ -42,6 +46,7 @@ class DiGraphSolver:
         self.revs = {i: k for k, i in self.keys.items() }
 
         # Determine the objective of the problem
+        self.steps      = desc.steps
         self.min_maxing = desc.steps in ['min', 'max']
         self.find_max   = desc.steps == 'max'
         self.step_count = desc.steps if not self.min_maxing else None
@@ -53,17 +58,29 @@ class DiGraphSolver:
         # Store the nodes dict in it's indexed form.
         self.nodes = {self.keys[head]: [self.keys[t] for t in tails] for head,tails in desc.nodes.items()}
 
+        # ... and flattened as two parallel arrays: one entry per arc.
+        self.heads = np.repeat(np.fromiter(self.nodes.keys(), dtype=int), [len(t) for t in self.nodes.values()])
+        self.tails = np.fromiter((t for tails in self.nodes.values() for t in tails), dtype=int)
+
         self.arcs = []
         self.vars = []
+        self.length = None
         self.result = []
 
     def setup(self):
+        self.setup_circuit()
+        self.set_objective(self.steps)
+
+    def setup_circuit(self):
         # AddCircuit uses a list of directed arcs as tuples: each is (head, tail, boolVariable)
         # where the  boolVar truth value represents if the arc is used or not used.
-        # List comprehension: for each head(node), create an arc for each of it's tails.
-        self.arcs = [
-            (head,tail, self.model.NewBoolVar(f'{head}:{tail}')) for head, tails in self.nodes.items() for tail in tails
-        ]
+        # The heads and tails are already flat, so just zip them with a fresh variable for each arc.
+        heads, tails = self.heads.tolist(), self.tails.tolist()
+        if DEBUG_NAMES:
+            arc_vars = [self.model.NewBoolVar(f'{head}:{tail}') for head, tail in zip(heads, tails)]
+        else:
+            arc_vars = [self.model.NewBoolVar('') for _ in tails]
+        self.arcs = list(zip(heads, tails, arc_vars))
 
         # vars is a list of all the arcs defined in the problem.
         self.vars = [arc[2] for arc in self.arcs]
@@ -71,7 +88,7 @@ class DiGraphSolver:
         # Add self loops for all *optional* nodes (because AddCircuit requires a Hamiltonian Circuit)
         # for this example, that's everywhere except for 'start' and 'stop'
         # We just use the keys of self.revs (the index values).
-        loops = [(n, n, self.model.NewBoolVar(f'{n}:{n}')) for n in self.revs if n not in [self.start, self.stop]]
+        loops = [(n, n, self.model.NewBoolVar(f'{n}:{n}' if DEBUG_NAMES else '')) for n in self.revs if n not in [self.start, self.stop]]
         self.arcs += loops
 
         # connect the stop variable to the start variable as a dummy arc to complete the hamiltonian circuit.
@@ -82,19 +99,35 @@ class DiGraphSolver:
         # Now add the circuit as a constraint.
         self.model.AddCircuit(self.arcs)
 
-        # Now set the objective.
+        # The path length is a variable of its own, so that the objective can be swapped
+        # without rebuilding the circuit.
+        self.length = self.model.NewIntVar(0, len(self.vars), 'length')
+        self.model.Add(sum(self.vars) == self.length)
+
+    def set_objective(self, steps):
+        # steps can be a specific number, 'min', or 'max'
+        self.steps      = steps
+        self.min_maxing = steps in ['min', 'max']
+        self.find_max   = steps == 'max'
+        self.step_count = steps if not self.min_maxing else None
+        self.result = []
+
+        self.model.ClearObjective()
+        self.model.ClearHints()
         if self.min_maxing:
             if self.find_max:
-                 self.model.Maximize(sum(self.vars))  # look for the longest network.
+                 self.model.Maximize(self.length)  # look for the longest network.
             else:
-                self.model.Minimize(sum(self.vars))   # look for the shortest network.
+                self.model.Minimize(self.length)   # look for the shortest network.
         else:
-            self.model.Add(sum(self.vars) == self.step_count)
+            # The hint is fixed by the solver (see solve), which pins the length to step_count.
+            self.model.AddHint(self.length, self.step_count)
 
     def solve(self) -> bool:
         cp_solver = cp_model.CpSolver()
         cp_solver.parameters.max_time_in_seconds = 1
         cp_solver.parameters.num_search_workers = 12
+        cp_solver.parameters.fix_variables_to_their_hinted_value = not self.min_maxing
         self.status = cp_solver.Solve(self.model)
         return self.summarise(cp_solver)
 
@@ -111,12 +144,14 @@ class DiGraphSolver:
 
     def store(self, cp_solver):
         self.timing = cp_solver.WallTime()
-        used = [arc for arc in self.arcs if cp_solver.Value(arc[2])]
-        arc = None, self.start
+        # Each node in the circuit has exactly one used arc leaving it, so index them by head.
+        used = {arc[0]: arc for arc in self.arcs if cp_solver.Value(arc[2])}
+        node = self.start
         while True:
-            arc = next((link for link in used if link[0] == arc[1]), None)
+            arc = used[node]
             self.result.append(self.revs[arc[0]])
-            if arc[1] == self.start:
+            node = arc[1]
+            if node == self.start:
                 break
         self.step_count = len(self.result) - 1
 
@@ -138,17 +173,15 @@ class RandomDigraph:
         self.start = 'a'
         self.stop = 'Z'
         but_first = set(names) ^ set(self.start)
-        self.nodes = {v: sample(but_first - set(v), arcs) for v in names}
+        self.nodes = {v: sample(sorted(but_first - set(v)), arcs) for v in names}
         self.nodes[self.stop] = []
 
     def print_nodes(self):
         for key, value in self.nodes.items():
             print(f'{key}: {value}')
 
-def solve_with_steps(problem, steps, show) -> int:
-    problem.steps = steps
-    solver = DiGraphSolver(problem)
-    solver.setup()
+def solve_with_steps(solver, steps, show) -> int:
+    solver.set_objective(steps)
     if solver.solve() and show:
         solver.show()
     return solver.step_count
@@ -157,10 +190,13 @@ def solve_az_paths_of_a_random_digraph():
     problem = RandomDigraph()
     problem.print_nodes()
     print()
-    min_steps = solve_with_steps(problem, 'min', True)
-    max_steps = solve_with_steps(problem, 'max', False)
+    # Build the circuit once, and re-use it for every step count.
+    solver = DiGraphSolver(problem)
+    solver.setup_circuit()
+    min_steps = solve_with_steps(solver, 'min', True)
+    max_steps = solve_with_steps(solver, 'max', False)
     for p in range(min_steps+1, max_steps+1):
-        solve_with_steps(problem, p, True)
+        solve_with_steps(solver, p, True)
 
 
 if __name__ == '__main__':
@@ -14,20 +14,28 @@
 """Domino Puzzle Solver
 This solves filling a space with a set of dominoes.
 """
+from collections import defaultdict
+import numpy as np
 from ortools.sat.python import cp_model
 
+# Box drawing characters, indexed by a bitmask of walls: W=1, E=2, N=4, S=8.
+_BOX = (' ', '╸', '╺', '═', '╹', '╝', '╚', '╩', '╻', '╗', '╔', '╦', '║', '╣', '╠', '╬')
+
 
 class DominoPuzzleSolver:
-    def __init__(self):
+    def __init__(self, debug=False):
         self.allow_gaps = False
         self.maximising = False
         self.status = cp_model.UNKNOWN
         self.solver = cp_model.CpSolver()
         self.solver.parameters.max_time_in_seconds = 6000
-        self.solver.parameters.num_search_workers = 6
-        self.solver.parameters.cp_model_presolve = False
-        self.solver.parameters.linearization_level = 0
-        self.solver.parameters.cp_model_probing_level = 0
+        # A full portfolio: the generic workers plus LNS workers, which suit packing problems.
+        self.solver.parameters.num_search_workers = 16
+        if debug:
+            # Keep the model as written: easier to follow, but much slower to solve.
+            self.solver.parameters.cp_model_presolve = False
+            self.solver.parameters.linearization_level = 0
+            self.solver.parameters.cp_model_probing_level = 0
 
         self.pieces = None
         self.ground = None
@@ -55,29 +63,37 @@ class DominoPuzzleSolver:
         available = problem['use'] if 'use' in problem else {k: 1 for k in pieces.names}
 
         """
-        For each lib piece that's being used (by default that's 112 = 4*28 - each of the 28 shapes rotated)..
+        For each lib piece that's being used (by default that's 98 = 4*21 + 2*7 - each of the 28 shapes rotated, doubles only twice)..
         See if it can be placed at each point in space, and if so, add it into the model as a potential presence
         of the solution. Also add it's coordinates into a placement dict so that we can test for overlaps later. 
         """
+        points = np.array(sorted(self.ground))
+        xs, ys = (points - points.min(axis=0)).T
+        # The ground as a bool mask, padded by 1 on the far sides, which is as far as a domino reaches.
+        ground_mask = np.zeros((ys.max() + 2, xs.max() + 2), dtype=bool)
+        ground_mask[ys, xs] = True
         for (name, rot), piece in pieces.lib.items():
             if name in available:
-                for point in self.ground:
-                    if piece.legal(self.ground, point):
-                        self.presence[(name, rot, point)] = model.NewBoolVar(f"{name, rot, point}")
-                        self.placement[(name, rot, point)] = Domino(name, rot, point)
+                legal = np.logical_and.reduce([ground_mask[ys + y, xs + x] for (x, y) in piece.pts])
+                for point in map(tuple, points[legal].tolist()):
+                    self.presence[(name, rot, point)] = model.NewBoolVar(f"{name, rot, point}")
+                    self.placement[(name, rot, point)] = Domino(name, rot, point)
 
         """
-        Compose pos_items - this is the set of all points of each domino at each x,y in the space.
+        Compose pos_items - this is the list of all points of each domino at each x,y in the space.
         We may use this for constraint setting and for rendering.
+        Each placement covers two distinct points, so the lists need no de-duplication.
+        At the same time, index every placement by the (point, value) of each of its halves,
+        so that finding the matching neighbours of a half is a lookup rather than a scan.
         """
-        self.pos_items = {x: set() for x in self.ground}
+        self.pos_items = {x: [] for x in self.ground}
+        by_val = defaultdict(list)
         for fix, p_bv in self.presence.items():
             domino = self.placement[fix]
             for point in domino.pos:
-                self.pos_items[point].add(fix)
+                self.pos_items[point].append(fix)
+                by_val[(point, domino.value_at(point))].append((fix, p_bv))
 
-        for k in self.pos_items:
-            self.pos_items[k] = list(self.pos_items[k])
         """
         Now do the domino bit - match numbers
         """
@@ -86,18 +102,10 @@ class DominoPuzzleSolver:
             legals = [(x+dx, y+dy) for dx, dy in offsets if (x+dx, y+dy) in self.ground]
             for fix in self.pos_items[(x, y)]:
                 fbv = self.presence[fix]
-                main = self.placement[fix]
-                # m_up = main.rotation in [0, 180]
-                value = main.value_at((x, y))
-                connections = []
-                for pos in legals:
-                    for fxo in self.pos_items[pos]:
-                        other = self.placement[fxo]
-                        # o_up = other.rotation in [0, 180]
-                        # this constraint prevents 0-0 counting as an internal path.
-                        if other != main and other.value_at(pos) == value:
-                            connections.append(self.presence[fxo])
-                model.Add(sum(connections) == 1).OnlyEnforceIf(fbv)
+                value = self.placement[fix].value_at((x, y))
+                # this constraint prevents 0-0 counting as an internal path.
+                connections = [bv for pos in legals for fxo, bv in by_val[(pos, value)] if fxo != fix]
+                model.Add(cp_model.LinearExpr.Sum(connections) == 1).OnlyEnforceIf(fbv)
 
         """
         Constraints are: 
@@ -126,9 +134,9 @@ class DominoPuzzleSolver:
         for pt_points in self.pos_items.values():
             items = [self.presence[i] for i in pt_points]
             if self.allow_gaps:
-                model.Add(sum(items) <= 1)
+                model.AddAtMostOne(items)
             else:
-                model.Add(sum(items) == 1)
+                model.AddExactlyOne(items)
 
         """
         Can now solve.
@@ -150,15 +158,12 @@ class DominoPuzzleSolver:
             return False
 
     @staticmethod
-    def box(*walls) -> str:
+    def box(w: bool, e: bool, n: bool, s: bool) -> str:
         """
-        :param walls: tuple of 4 bool: W,E,N,S
+        :param w, e, n, s: 4 bool: W,E,N,S
         :return: related box drawing character.
         """
-        value = 0
-        for i, wall in enumerate(walls):
-            value |= 1 << i if wall else 0
-        return (' ', '╸', '╺', '═', '╹', '╝', '╚', '╩', '╻', '╗', '╔', '╦', '║', '╣', '╠', '╬')[value & 0x0F]
+        return _BOX[w | e << 1 | n << 2 | s << 3]
 
     def draw(self):
         """
@@ -212,7 +217,10 @@ class Domino:
     """
      A domino is two adjacent squares, with a value in each square.
      While subject to rotations, each number is fixed to an end.
+     There is one of these for every placement in a model, so keep them slim.
     """
+    __slots__ = ('l', 'r', 'x', 'y', 'rotation', 'pts', 'pos', 'a', 'b', 'values')
+
     rot_map = {
         0: [(0, 0), (1, 0)],
         90: [(0, 0), (0, 1)],
@@ -227,6 +235,7 @@ class Domino:
         self.pts = None
         self.pos = None
         self.a, self.b = None, None
+        self.values = None
         self.setup(rotation)
 
     # def pos(self) -> list:
@@ -237,23 +246,10 @@ class Domino:
         self.pts = Domino.rot_map[self.rotation]
         self.pos = [(x + self.x, y + self.y) for (x, y) in self.pts]
         self.a, self.b = (self.l, self.r) if theta in [0, 90] else (self.r, self.l)
+        self.values = dict(zip(self.pos, (self.a, self.b)))
 
     def value_at(self, pos: tuple) -> [None, int]:
-        for i, pt in enumerate(self.pos):
-            if pt == pos:
-                return self.a if i == 0 else self.b
-        return None
-
-    def legal(self, ground: set, offs: tuple) -> bool:
-        """
-        Given an (x,y) offset, and a 'space' of legal points check to see if a domino can
-        be legally placed in it.
-        """
-        ox, oy = offs
-        for (x, y) in self.pts:
-            if (x + ox, y + oy) not in ground:
-                return False
-        return True
+        return self.values.get(pos)
 
 
 class DominoCollection:
@@ -262,7 +258,12 @@ class DominoCollection:
     """
 
     def __init__(self, values):
-        self.lib = {(value, rot): Domino(value, rot) for value in values for rot in [0, 90, 180, 270]}
+        # A double reads the same when turned through 180, so it only needs two rotations.
+        self.lib = {
+            (value, rot): Domino(value, rot)
+            for value in values
+            for rot in ([0, 90] if value[0] == value[1] else [0, 90, 180, 270])
+        }
         self.names = values
 
 
@@ -26,29 +26,41 @@
     (3) Solves the minimum and maximum paths.
     (4) Solves (or fails) for seeking path-lengths from minimum to maximum steps long printing the result.
 """
+import numpy as np
 from ortools.sat.python import cp_model
 
+# Box drawing characters, indexed by a bitmask of walls: W=1, E=2, N=4, S=8.
+_BOX = (' ', '╸', '╺', '═', '╹', '╝', '╚', '╩', '╻', '╗', '╔', '╦', '║', '╣', '╠', '╬')
+
 
 class SolutionCallback(cp_model.CpSolverSolutionCallback):
     def __init__(self, graph, space, place, fixes):
         cp_model.CpSolverSolutionCallback.__init__(self)
-        self.solver = None
         self.graph = graph
         self.space = space
         self.place = place
         self.fixes = fixes
+        # The bounds of the space are fixed for the problem, so derive them once.
+        xs = [p[0] for p in space]
+        ys = [p[1] for p in space]
+        self.x1, self.x2, self.y1, self.y2 = min(xs), max(xs), min(ys), max(ys)
+        # The placement variables as a flat grid of model indices, [y, x, fix], with the a and b of each fix
+        # alongside.  Squares outside the space point at -1: one past the end of the solution once padded in draw.
+        fix_list = list(dict.fromkeys((a, b) for (x, y, a, b) in place))
+        fix_id = {fix: i for i, fix in enumerate(fix_list)}
+        self.fix_a = np.array([a for a, b in fix_list])
+        self.fix_b = np.array([b for a, b in fix_list])
+        self.place_index = np.full((self.y2 + 1 - self.y1, self.x2 + 1 - self.x1, len(fix_list)), -1)
+        for (x, y, a, b), var in place.items():
+            self.place_index[y - self.y1, x - self.x1, fix_id[a, b]] = var.Index()
         self.solutions = 0
         self.show_circuit = True
         self.show_space = True
 
     def val(self, variable):
-        if self.solver:
-            return self.solver.Value(variable)
-        else:
-            return self.Value(variable)
+        return self.Value(variable)
 
-    def on_solution_callback(self, solver=None):
-        self.solver = solver
+    def on_solution_callback(self):
         # Many thousands of solutions.
         self.solutions += 1
         if self.show_circuit:
@@ -58,83 +70,78 @@ class SolutionCallback(cp_model.CpSolverSolutionCallback):
                 for h, hd in fs['fixes'].items()
                 for t, tv in hd['tail_vars'] if self.val(tv)
             ]
-            arc = used[0]
-            while arc:
-                used.remove(arc)
-                result.append(arc[0])
-                arc = next((link for link in used if link[0] == arc[1]), None)
-            if len(set(result)) != len(result):
+            # Each fix in the circuit is the head of exactly one used arc, so walk them by head.
+            # Two used arcs with the same head would collapse into one here, so that is where duplicates show.
+            nxt = dict(used)
+            if len(nxt) != len(used):
                 print('duplicates found!')
-            if used:
-                result.append(['unused:', used])
+            cur = used[0][0]
+            while cur in nxt:
+                result.append(cur)
+                cur = nxt.pop(cur)
+            if nxt:
+                result.append(['unused:', list(nxt.items())])
             print(f"{' '.join([str(x) for x in result])}")
         if self.show_space:
             self.draw()
 
     def draw(self):
-        def box(*walls) -> str:
-            """
-            :param walls: tuple of 4 bool: W,E,N,S
-            :return: related box drawing character.
-            """
-            idx = 0
-            for i, wall in enumerate(walls):
-                idx |= 1 << i if wall else 0
-            return (' ', '╸', '╺', '═', '╹', '╝', '╚', '╩', '╻', '╗', '╔', '╦', '║', '╣', '╠', '╬')[idx & 0x0F]
-
         """
         Derive grid size, based upon the min/max x,y values set in the space
         """
-        x1 = min(self.space, key=lambda l: l[0])[0]
-        y1 = min(self.space, key=lambda l: l[1])[1]
-        x2 = max(self.space, key=lambda l: l[0])[0]
-        y2 = max(self.space, key=lambda l: l[1])[1]
-        mt = ('~', ' ')
+        x1, x2, y1, y2 = self.x1, self.x2, self.y1, self.y2
+        x_dim = x2 + 1 - x1
+        y_dim = y2 + 1 - y1
 
-        fixed = [fix for fix in self.fixes if self.val(self.fixes[fix])]
-        placed = [pla for pla in self.place if self.val(self.place[pla])]
+        """
+        Compose the grid, based upon solver values, as two arrays: the a and b of the fix at each cell.
+        They are padded with a border of empty (-1) cells, so that every interstice has four neighbours.
+        """
+        a_grid = np.full((y_dim + 2, x_dim + 2), -1)
+        b_grid = np.full((y_dim + 2, x_dim + 2), -1)
+        solution = np.append(self.Response().solution, 0)
+        yy, xx, ff = solution[self.place_index].nonzero()
+        a_grid[yy + 1, xx + 1] = self.fix_a[ff]
+        b_grid[yy + 1, xx + 1] = self.fix_b[ff]
 
         """
-        Compose grid dict, based upon solver values
+        Find the walls of every interstice at once, looking from the top left of each cell.
         """
-        grid = {}
-        for y in range(y1, y2 + 1):
-            for x in range(x1, x2 + 1):
-                grid[x - x1, y - y1] = mt
-                for dd in self.graph.values():
-                    for (a, b) in dd['fixes']:
-                        if self.val(self.place[(x, y, a, b)]):
-                            grid[x - x1, y - y1] = (a, b)
+        nw = a_grid[:-1, :-1], b_grid[:-1, :-1]
+        ne = a_grid[:-1, 1:], b_grid[:-1, 1:]
+        sw = a_grid[1:, :-1], b_grid[1:, :-1]
+        se = a_grid[1:, 1:], b_grid[1:, 1:]
+        w = ~self.same(nw, sw)  # is there a western interstice?
+        e = ~self.same(ne, se)  # is there an eastern interstice?
+        n = ~self.same(nw, ne)  # is there a northern interstice?
+        s = ~self.same(se, sw)  # is there a southern interstice?
+        corner = w | e << 1 | n << 2 | s << 3  # the box drawing index of each interstice.
 
         """
-        Draw grid using box drawing characters
+        Draw grid using box drawing characters.
+        Everything the rows need is pulled out of the arrays as plain ints in one go, so the row loops
+        only index tuples and lists, rather than reading NumPy scalars one at a time.
         """
-        x_dim = x2 + 1 - x1
-        y_dim = y2 + 1 - y1
+        corners = corner.tolist()
+        spans = (e * 3).tolist()    # 3 is W|E: a horizontal wall.
+        sides = (s * 12).tolist()   # 12 is N|S: a vertical wall.
+        digits = b_grid[1:-1, 1:-1].tolist()
         for y in range(y_dim + 1):
-            line = ""
-            # So, we are drawing the interstices here, looking from the top left of each cell.
-            for x in range(x_dim + 1):
-                nwa, nwb = grid[x - 1, y - 1] if 0 <= y - 1 < y_dim and 0 <= x - 1 < x_dim else mt
-                nea, neb = grid[x - 0, y - 1] if 0 <= y - 1 < y_dim and 0 <= x - 0 < x_dim else mt
-                swa, swb = grid[x - 1, y - 0] if 0 <= y - 0 < y_dim and 0 <= x - 1 < x_dim else mt
-                sea, seb = grid[x - 0, y - 0] if 0 <= y - 0 < y_dim and 0 <= x - 0 < x_dim else mt
-                w = not((nwa == swa and nwb == swb) or (nwa == swb and nwb == swa))  # is there a western interstice?
-                e = not((nea == sea and neb == seb) or (nea == seb and neb == sea))  # is there a western interstice?
-                n = not((nwa == nea and nwb == neb) or (nwa == neb and nwb == nea))  # is there a western interstice?
-                s = not((sea == swa and seb == swb) or (sea == swb and seb == swa))  # is there a western interstice?
-                # eyes = [((nwa, nwb), (nea, neb), (swa, swb), (sea, seb)), (w, e, n, s)]
-                line += box(w, e, n, s) + 3 * box(e, e, False, False)
-            print(line)
+            print(''.join([_BOX[c] + 3 * _BOX[h] for c, h in zip(corners[y], spans[y])]))
             #  now to do y-intermediate.
             if y < y_dim:
-                line = ""
-                for x in range(x_dim):
-                    ca, cb = grid[x, y]
-                    wa, wb = grid[x - 1, y] if 0 <= x - 1 < x_dim else mt
-                    cw = not((ca == wa and cb == wb) or (ca == wb and cb == wa))
-                    line += f'{box(False, False, cw, cw)} {cb} '
-                print(f'{line}║')
+                # The wall between a cell and its western neighbour is the south of its top-left interstice.
+                parts = [f'{_BOX[v]} {cb if cb >= 0 else " "} ' for v, cb in zip(sides[y], digits[y])]
+                parts.append('║')
+                print(''.join(parts))
+
+    @staticmethod
+    def same(p, q):
+        """
+        Elementwise, for two (a, b) pairs of arrays: do the cells hold the same fix of a domino, either way round?
+        """
+        (pa, pb), (qa, qb) = p, q
+        return ((pa == qa) & (pb == qb)) | ((pa == qb) & (pb == qa))
 
 
 class DiGraphSolver:
@@ -153,6 +160,7 @@ class DiGraphSolver:
         self.space = space
         self.place = dict()
         self.fixes = dict()
+        self._all_fixes = []
 
     def set_circuit(self):
         # AddCircuit uses a list of directed arcs as tuples: each is (head, tail, boolVariable)
@@ -168,20 +176,24 @@ class DiGraphSolver:
 
         # Because AddCircuit requires a Hamiltonian Circuit, one needs to add loops to optional nodes.
         # Here, that is where there are multiple fixes for a domino.
+        # The arc and loop variables are many and are never read by name, so they are left unnamed.
+        new_bool_var = self.model.NewBoolVar
+        add = self.model.Add
         arcs = []
         loops = []
         for fs in self.graph.values():
             d_arcs = []
+            optional = len(fs['fixes']) > 1
             for h, hd in fs['fixes'].items():
-                hd['tail_vars'] = [(t, self.model.NewBoolVar(f'arc {h}:{t}')) for t in hd['tails']]
-                d_arcs += [(idx[h], idx[t], var) for t, var in hd['tail_vars']]
-                if len(fs['fixes']) > 1:
-                    loops.append((idx[h], idx[h], self.model.NewBoolVar(f'Loop {h}')))
-            self.model.Add(sum([a[2] for a in d_arcs]) == 1)
-            arcs += d_arcs
+                hd['tail_vars'] = [(t, new_bool_var('')) for t in hd['tails']]
+                d_arcs.extend([(idx[h], idx[t], var) for t, var in hd['tail_vars']])
+                if optional:
+                    loops.append((idx[h], idx[h], new_bool_var('')))
+            add(sum([a[2] for a in d_arcs]) == 1)
+            arcs.extend(d_arcs)
 
         # Ensure that every domino is used.
-        self.model.Add(sum([a[2] for a in arcs]) == len(self.graph))
+        add(sum([a[2] for a in arcs]) == len(self.graph))
 
         # Now add the circuit as a constraint.
         self.model.AddCircuit(arcs + loops)
@@ -197,21 +209,28 @@ class DiGraphSolver:
             If there are numbers on the grid, that limits which variables can go on it, but that's all.
             All placements are represented by X*Y*Fixes boolVars.
         """
-        # Set up the variables
-        for dd in self.graph.values():                                   # for each domino directory..
-            for (a, b), hd in dd['fixes'].items():                       # for each fix..
-                self.fixes[a, b] = self.model.NewBoolVar(f'fix {a, b}')  # store a fix variable.
-                for (x, y) in self.space:
-                    self.place[x, y, a, b] = self.model.NewBoolVar(f'fix {a,b} at {x,y}')  # the 'b' of this fix at x,y
+        # The orthogonal neighbours of each point, within the space.
+        adj_of = {
+            (x, y): [ij for ij in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)] if ij in self.space]
+            for (x, y) in self.space
+        }
+
+        # Set up the variables, also gathering the placements at each point as we go.
+        new_bool_var = self.model.NewBoolVar
+        by_xy = {xy: [] for xy in self.space}
+        for a, b, hd in self._all_fixes:                                 # for each fix..
+            self.fixes[a, b] = new_bool_var(f'fix {a, b}')               # store a fix variable.
+            for (x, y) in self.space:
+                self.place[x, y, a, b] = new_bool_var('')                # the 'b' of this fix at x,y
+                by_xy[x, y].append(self.place[x, y, a, b])
 
         # Connect the arcs to the fixes.
-        for dd in self.graph.values():  # for each domino directory..
-            for (a, b), hd in dd['fixes'].items():                       # for the head.ab of each fix
-                for (i, j), arc in [v for v in hd['tail_vars']]:         # for the tail.ij of each tail
-                    self.model.AddImplication(arc, self.fixes[a, b])      # if the arc is true, the head is true
-                    self.model.AddImplication(arc, self.fixes[i, j])      # if the arc is true, the tail is true
-                    self.model.AddImplication(self.fixes[a, b].Not(), arc.Not())      # !head => ! arc
-                    self.model.AddImplication(self.fixes[i, j].Not(), arc.Not())      # !tail => ! arc
+        for a, b, hd in self._all_fixes:                                 # for the head.ab of each fix
+            for (i, j), arc in hd['tail_vars']:                          # for the tail.ij of each tail
+                self.model.AddImplication(arc, self.fixes[a, b])          # if the arc is true, the head is true
+                self.model.AddImplication(arc, self.fixes[i, j])          # if the arc is true, the tail is true
+                self.model.AddImplication(self.fixes[a, b].Not(), arc.Not())      # !head => ! arc
+                self.model.AddImplication(self.fixes[i, j].Not(), arc.Not())      # !tail => ! arc
 
         # Basic fix logic..
         for (a, b), fix in self.fixes.items():
@@ -224,9 +243,9 @@ class DiGraphSolver:
 
         # Connect fixes to space.  Each space will either be the head or a tail of a fix.
         for (x, y) in self.space:
-            self.model.Add(sum([self.place[x, y, a, b] for a, b in self.fixes]) == 1)  # with 1 at each..
+            self.model.Add(sum(by_xy[x, y]) == 1)  # with 1 at each..
+            adj = adj_of[x, y]
             for (a, b), fix in self.fixes.items():
-                adj = [ij for ij in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)] if ij in self.space]
                 halves = [self.place[x, y, a, b].Not()]
                 for (i, j) in adj:  # for each point adjacent to B...
                     tmp = self.model.NewBoolVar('half')
@@ -235,43 +254,48 @@ class DiGraphSolver:
                 self.model.Add(sum(halves) == 1).OnlyEnforceIf(self.place[x, y, a, b])
 
         # connect domino tails to their heads.
-        for dd in self.graph.values():  # for each domino directory..
-            for (a, b), hd in dd['fixes'].items():                       # for the head.ab of each fix
-                for (j, i), arc in [v for v in hd['tail_vars']]:         # for the tail.ij of each tail
-                    joins = []
-                    for (x, y) in self.space:
-                        for u, v in [uv for uv in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)] if uv in self.space]:
-                            tmp = self.model.NewBoolVar('join')
-                            self.model.AddImplication(self.fixes[j, i], self.place[u, v, i, j]).OnlyEnforceIf(tmp)
-                            self.model.Add(self.place[x, y, a, b] == self.place[u, v, i, j]).OnlyEnforceIf(tmp)
-                            self.model.AddImplication(
-                                self.place[x, y, a, b], self.place[u, v, i, j].Not()
-                            ).OnlyEnforceIf(tmp.Not())
-                            joins.append(tmp)
-                    self.model.Add(sum(joins) == 1).OnlyEnforceIf(arc)
+        # If an arc is used, the b of its head and the j of its tail are neighbours.
+        # A double's placement is true at both of its squares, so anchor on whichever end is not a double:
+        # that end is at a single square, and one of that square's neighbours must hold the other end.
+        # (anchor at x,y and arc) => a neighbour, is posted as arc => (not anchor at x,y, or a neighbour),
+        # so every clause is enforced by the one arc literal.
+        for a, b, hd in self._all_fixes:                                 # for the head.ab of each fix
+            for (j, i), arc in hd['tail_vars']:                          # for the tail.ij of each tail
+                anchor, other = ((a, b), (i, j)) if a != b else ((i, j), (a, b))
+                for (x, y) in self.space:
+                    self.model.AddBoolOr(
+                        [self.place[x, y, anchor[0], anchor[1]].Not()] +
+                        [self.place[u, v, other[0], other[1]] for u, v in adj_of[x, y]]
+                    ).OnlyEnforceIf(arc)
 
     def setup(self):
         # Set the master pieces. they should all be used.
         # placements uses circuit values.
+        # Every pass over the fixes walks the same (a, b, head-dict) triples, so flatten them once.
+        self._all_fixes = [(a, b, hd) for dd in self.graph.values() for (a, b), hd in dd['fixes'].items()]
         self.set_circuit()
         self.set_placements()
 
     def solve(self) -> bool:
         cp_solver = cp_model.CpSolver()
         cp_solver.parameters.num_search_workers = 12
+        # The board is full of interchangeable placements, and the model is mostly sums == 1 and channelling,
+        # so let the solver look for symmetries and give it the stronger linear relaxation.
+        cp_solver.parameters.symmetry_level = 2
+        cp_solver.parameters.linearization_level = 2
+        cp_solver.parameters.cp_model_probing_level = 2
         # cp_solver.parameters.cp_model_presolve = False
         # cp_solver.parameters.log_search_progress = True
         # cp_solver.parameters.linearization_level = 0
         # cp_solver.parameters.max_presolve_iterations = 1000
         # cp_solver.parameters.cp_model_probing_level = 1000
         solution_callback = SolutionCallback(self.graph, self.space, self.place, self.fixes)
-        self.status = cp_solver.Solve(self.model)
-        return self.summarise(cp_solver, solution_callback)
+        self.status = cp_solver.Solve(self.model, solution_callback)
+        return self.summarise(cp_solver)
         # self.status = cp_solver.SearchForAllSolutions(self.model, solution_printer)
 
-    def summarise(self, cp_solver, callback) -> bool:
+    def summarise(self, cp_solver) -> bool:
         if self.status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
-            callback.on_solution_callback(cp_solver)
             return True
         else:
             if self.status == cp_model.INFEASIBLE:
@@ -296,14 +320,17 @@ class DominoDigraph:
         dominoes = set((x, y) for y in range(size+1) for x in range(y, size+1))
         # fix the rotations and store against each master
         fixed = {(a, b): {(a, b), (b, a)} for (a, b) in dominoes}
+        # index every fix by its head digit, so that the candidate tails of a fix can be looked up.
+        by_head = {}
+        for o, o_fixes in fixed.items():
+            for o_fix in o_fixes:
+                by_head.setdefault(o_fix[0], []).append((o, o_fix))
         # for each Domino; for each of it's fix; find those fixes from the Other dominoes which are potential tails.
         self.graph = {
             d: {
                 'fixes': {
                     d_fix: {   # connect the other(o) potential dominoes as tails to each fix
-                        'tails': [
-                            o_fix for o, o_fixes in fixed.items() if o != d for o_fix in o_fixes if o_fix[0] == d_fix[1]
-                        ]
+                        'tails': [o_fix for o, o_fix in by_head[d_fix[1]] if o != d]
                     } for d_fix in d_fixes
                 }
              } for d, d_fixes in fixed.items()
@@ -85,6 +85,8 @@
     strictly necessary, because we will have to tie both of these sets of variables together with 'glue'.
 
 """
+from collections import defaultdict
+import numpy as np
 from ortools.sat.python import cp_model
 
 
@@ -136,10 +138,11 @@ class SolutionManager(cp_model.CpSolverSolutionCallback):
                     line += f'{box(False, False, cw, cw)} {obj[i]} '
                 print(f'{line}║')
 
-    def __init__(self, place):
+    def __init__(self, halves, fixes):
         cp_model.CpSolverSolutionCallback.__init__(self)
         self.solver = None
-        self.place = place
+        self.halves = halves  # (tails, heads), each [a, b][x, y]
+        self.fixes = fixes
         self.solutions = 0
         self.show_fixes = False
         self.show_circuit = False
@@ -151,6 +154,12 @@ class SolutionManager(cp_model.CpSolverSolutionCallback):
         else:
             return self.Value(variable)
 
+    def bool_val(self, variable) -> bool:
+        if self.solver:
+            return self.solver.BooleanValue(variable)
+        else:
+            return self.BooleanValue(variable)
+
     def on_solution_callback(self, solver=None):
         self.solver = solver
         self.solutions += 1
@@ -161,19 +170,19 @@ class SolutionManager(cp_model.CpSolverSolutionCallback):
         if self.show_circuit:
             result = []
             used = [
-                (h, t) for fs in self.graph.values()
-                for h, hd in fs['fixes'].items()
-                for t, tv in hd['tail_vars'].items() if self.val(tv)
+                (fix.head, t) for fix in self.graph
+                for t, tv in fix.tail_vars if self.val(tv)
             ]
-            arc = used[0]
-            while arc:
-                used.remove(arc)
-                result.append(arc[0])
-                arc = next((link for link in used if link[0] == arc[1]), None)
+            # Each fix in the circuit is the head of exactly one used arc, so walk them by head.
+            nxt = dict(used)
+            cur = used[0][0]
+            while cur in nxt:
+                result.append(cur)
+                cur = nxt.pop(cur)
             if len(set(result)) != len(result):
                 print('duplicates found!')
-            if used:
-                result.append(['unused:', used])
+            if nxt:
+                result.append(['unused:', list(nxt.items())])
             print(f"{' '.join([str(x) for x in result])}")
         if self.show_space:
             self.box_draw(self.set_grid())
@@ -183,7 +192,11 @@ class SolutionManager(cp_model.CpSolverSolutionCallback):
         [x,y]: index of, and tuple of shape identity (represented as a tuple of numbers)
         eg, [0,0]: 0,(4,1)  => the 4 of the 4,1 domino is at [0,0]
         """
-        return {(x, y): (i, (a, b)) for (x, y, a, b, i), var in self.place.items() if self.val(var)}
+        active = [ab for ab, var in self.fixes.items() if self.bool_val(var)]        # only these can be placed.
+        return {
+            xy: (i, ab) for i, halves in enumerate(self.halves) for ab in active
+            for xy, var in halves[ab].items() if self.bool_val(var)
+        }
 
 
 class DominoBraneSolver:
@@ -193,15 +206,15 @@ class DominoBraneSolver:
         self.status = cp_model.UNKNOWN
 
         """
-         Graph has 3 layers:
-           1st is the node proper
-           2nd is the set of node fixes (only one of which is allowed) which are presented as nodes of a digraph
-           3rd is the list of potential tails for that fix.
+         Graph is a flat list of every Fix, each of which knows its domino (only one fix of which is allowed)
+         and is presented as a node of a digraph, along with the list of its potential tails.
         """
         self.graph = graph
         self.space = space
-        self.place = dict()
         self.fixes = dict()
+        self.heads = dict()
+        self.tails = dict()
+        self.neighbors = dict()
 
     def set_circuit(self):
         # AddCircuit uses a list of directed arcs as tuples: each is (head, tail, boolVariable)
@@ -210,100 +223,227 @@ class DominoBraneSolver:
 
         # For setting up the circuit, fixes of each domino as a distinct node.
         # 'nodes' includes every possible fix there is.
-        self.fixes = {node: self.model.NewBoolVar(f'fix {node}') for dom, fixes in self.graph.items() for node in fixes['fixes']}
+        self.fixes = {fix.head: self.model.NewBoolVar(f'fix {fix.head}') for fix in self.graph}
 
         # Because AddCircuit requires numbers, we create a map of nodes->ints
         idx = {k: i for i, k in enumerate(self.fixes)}
 
         # Because AddCircuit requires a Hamiltonian Circuit, one needs to add loops to optional nodes.
-        # Here, that is where there are multiple fixes for a domino.
-        arcs = []
+        # Here, that is where there are multiple fixes for a domino, ie. it's not a double.
+        d_arcs = {fix.domino: [] for fix in self.graph}
         loops = []
-        for fs in self.graph.values():
-            d_arcs = []
-            for h, hd in fs['fixes'].items():
-                hd['tail_vars'] = dict()
-                for t in hd['tails']:
-                    arc = self.model.NewBoolVar(f'arc {h}:{t}')
-                    self.model.AddImplication(arc, self.fixes[h])
-                    self.model.AddImplication(arc, self.fixes[t])
-                    self.model.AddImplication(self.fixes[h].Not(), arc.Not())      # !head => ! arc
-                    self.model.AddImplication(self.fixes[t].Not(), arc.Not())      # !tail => ! arc
-                    hd['tail_vars'][t] = arc
-                    d_arcs.append((idx[h], idx[t], arc))
-                if len(fs['fixes']) > 1:
-                    loops.append((idx[h], idx[h], self.model.NewBoolVar(f'Loop {h}')))
-            self.model.Add(sum([a[2] for a in d_arcs]) == 1)
-            arcs += d_arcs
+        for fix in self.graph:
+            h = fix.head
+            fix.tail_vars = []
+            if not fix.tails:
+                # Nothing can follow this fix, so it can't be in the circuit.
+                self.model.Add(self.fixes[h] == 0)
+            for t in fix.tails:
+                arc = self.model.NewBoolVar(f'arc {h}:{t}')
+                self.model.AddBoolAnd([self.fixes[h], self.fixes[t]]).OnlyEnforceIf(arc)  # and so !head or !tail => !arc
+                fix.tail_vars.append((t, arc))
+                d_arcs[fix.domino].append((idx[h], idx[t], arc))
+            if h[0] != h[1]:
+                loops.append((idx[h], idx[h], self.model.NewBoolVar(f'Loop {h}')))
+        arcs = []
+        for domino_arcs in d_arcs.values():
+            self.model.AddExactlyOne([a[2] for a in domino_arcs])
+            arcs += domino_arcs
 
         # Ensure that every domino is used.
-        self.model.Add(sum([a[2] for a in arcs]) == len(self.graph))
+        self.model.Add(sum([a[2] for a in arcs]) == len(d_arcs))
 
-        # Now add the circuit as a constraint.
-        self.model.AddCircuit(arcs + loops)
+        # Now add the circuit as a constraint (with no arcs at all, the domino count above is already infeasible).
+        if arcs + loops:
+            self.model.AddCircuit(arcs + loops)
+
+        # Every circuit can be run the other way round, which flips the fix of every domino.
+        # Choosing the fix of one non-double domino keeps just one of those two directions.
+        d = min((fix.domino for fix in self.graph if fix.domino[0] != fix.domino[1]), default=None)
+        if d is not None:
+            self.model.Add(self.fixes[d] == 1)
 
     def set_placements(self):
         # Set up the variables
         fixes_to_be_placed = len(self.space) // 2
         self.model.Add(sum(self.fixes.values()) == fixes_to_be_placed)          # This acts as a 'hint' - speed.
 
-        for (a, b), fix in self.fixes.items():                                   # for each domino directory..
-            for (x, y) in self.space:
-                if self.space[x, y] is None:
-                    self.place[x, y, a, b, 1] = self.model.NewBoolVar(f'H {a, b} at {x, y}')  # 'b' of the a,b fix at x,y
-                    self.place[x, y, a, b, 0] = self.model.NewBoolVar(f'T {a, b} at {x, y}')  # 'b' of the a,b fix at x,y
-                else:
-                    if self.space[x, y] == b:
-                        self.place[x, y, a, b, 1] = self.model.NewBoolVar(f'H {a, b} at {x, y}')  # 'b' of the a,b fix at x,y
-                    if self.space[x, y] == a:
-                        self.place[x, y, a, b, 0] = self.model.NewBoolVar(f'T {a, b} at {x, y}')  # 'b' of the a,b fix at x,y
+        # heads[a, b] and tails[a, b] hold the squares where the 'b' (head) or 'a' (tail) of the a,b fix may lie.
+        # Keeping them per fix means each loop below only visits the squares that fix can actually reach.
+        self.heads = {ab: dict() for ab in self.fixes}
+        self.tails = {ab: dict() for ab in self.fixes}
+        # A half can lie on an open square, or on a square whose clue matches it.
+        # Work that out for every fix and square at once, as (fix, square) masks; -1 marks an open square.
+        squares = list(self.space)
+        clue = np.array([-1 if val is None else val for val in self.space.values()])
+        ab = np.array(list(self.fixes)).reshape(-1, 2)
+        head_ok = (clue == -1) | (clue == ab[:, 1:])
+        tail_ok = (clue == -1) | (clue == ab[:, :1])
+        for f, (a, b) in enumerate(self.fixes):                                  # for each domino directory..
+            for s in np.flatnonzero(head_ok[f]).tolist():
+                x, y = squares[s]
+                self.heads[a, b][x, y] = self.model.NewBoolVar(f'H {a, b} at {x, y}')  # 'b' of the a,b fix at x,y
+            for s in np.flatnonzero(tail_ok[f]).tolist():
+                x, y = squares[s]
+                self.tails[a, b][x, y] = self.model.NewBoolVar(f'T {a, b} at {x, y}')  # 'a' of the a,b fix at x,y
 
         # Connect fixes to space.
         for (a, b), fix in self.fixes.items():
-            self.model.Add(sum([self.place[x, y, a, b, 1] for x, y in self.space if (x, y, a, b, 1) in self.place]) == sum([self.fixes[a, b]]))
-            self.model.Add(sum([self.place[x, y, a, b, 0] for x, y in self.space if (x, y, a, b, 0) in self.place]) == sum([self.fixes[a, b]]))
+            # sum(halves) == fix, as exactly one of the halves or 'not fix'.
+            self.model.AddExactlyOne(list(self.heads[a, b].values()) + [fix.Not()])
+            self.model.AddExactlyOne(list(self.tails[a, b].values()) + [fix.Not()])
+
+        # The orthogonal neighbours of each square, and the tail halves of each fix which could lie next to it.
+        # Both are used over and over below, so work them out just once.
+        self.neighbors = {
+            (x, y): tuple(ij for ij in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)] if ij in self.space)
+            for (x, y) in self.space
+        }
+        tails_by_ab_xy = {
+            (a, b, x, y): [cells[ij] for ij in adj if ij in cells]
+            for (a, b), cells in self.tails.items() for (x, y), adj in self.neighbors.items()
+        }
 
         # Each square will either be the head (1) or a tail (0) of a fix.
-        for (x, y) in self.space:
-            self.model.Add(sum([self.place[x, y, a, b, f] for a, b in self.fixes for f in [0, 1] if (x, y, a, b, f) in self.place]) == 1)  # 1 half at each square.
-            for (a, b) in self.fixes:
-                if (x, y, a, b, 1) in self.place:
-                    adj = [ij for ij in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)] if ij in self.space]
-                    halves = [self.place[i, j, a, b, 0] for (i, j) in adj if (i, j, a, b, 0) in self.place]
-                    self.model.AddBoolOr(halves).OnlyEnforceIf(self.place[x, y, a, b, 1])
+        halves_at = {xy: [] for xy in self.space}
+        for halves in (self.heads, self.tails):
+            for cells in halves.values():
+                for xy, var in cells.items():
+                    halves_at[xy].append(var)
+        for halves in halves_at.values():
+            self.model.AddExactlyOne(halves)  # 1 half at each square.
+        for (a, b), cells in self.heads.items():
+            for (x, y), head in cells.items():
+                self.model.AddBoolOr(tails_by_ab_xy[a, b, x, y]).OnlyEnforceIf(head)
 
         # Connect domino tails to their heads.
-        for dd in self.graph.values():  # for each domino directory..
-            for (a, b), hd in dd['fixes'].items():            # for the head.ab of each fix
-                for (c, d), arc in hd['tail_vars'].items():   # for the tail.uv of each tail
-                    for (x, y) in self.space:
-                        if (x, y, a, b, 1) in self.place:
-                            adj = [ij for ij in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)] if ij in self.space]
-                            tails = [self.place[i, j, c, d, 0] for (i, j) in adj if (i, j, c, d, 0) in self.place]
-                            self.model.AddBoolOr(tails).OnlyEnforceIf(self.place[x, y, a, b, 1]).OnlyEnforceIf(arc)
+        for fix in self.graph:                      # for the head.ab of each fix
+            (a, b) = fix.head
+            for (c, d), arc in fix.tail_vars:       # for the tail.uv of each tail
+                for (x, y), head in self.heads[a, b].items():
+                    self.model.AddBoolOr(tails_by_ab_xy[c, d, x, y]).OnlyEnforceIf([head, arc])
 
         # Reduce ambiguity -- (8 seconds instead of 1.5).
-        for (x, y) in self.space:
-            for (a, b) in self.fixes:
-                if (x, y, a, b, 1) in self.place:
-                    adj = [ij for ij in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)] if ij in self.space]
-                    vals = [self.place[i, j, u, v, f] for f in [0, 1] for (i, j) in adj for (u, v) in self.fixes if u == b and (i, j, u, v, f) in self.place]
-                    if a == b:
-                        self.model.Add(sum(vals) == 2).OnlyEnforceIf(self.place[x, y, a, b, 1])
-                    else:
-                        self.model.Add(sum(vals) == 1).OnlyEnforceIf(self.place[x, y, a, b, 1])
+        for (a, b), cells in self.heads.items():
+            follows = [uv for uv in self.fixes if uv[0] == b]
+            for (x, y), head in cells.items():
+                adj = self.neighbors[x, y]
+                vals = [d[uv][ij] for d in (self.tails, self.heads) for ij in adj for uv in follows if ij in d[uv]]
+                need = 2 if a == b else 1
+                if len(vals) < need:            # the head can never be placed here.
+                    self.model.Add(head == 0)
+                elif len(vals) == need:         # every neighbour must be used.
+                    self.model.AddBoolAnd(vals).OnlyEnforceIf(head)
+                else:
+                    self.model.Add(sum(vals) == need).OnlyEnforceIf(head)
+
+    def set_symmetry(self):
+        """
+        Reflecting a solution across the middle of the board (or turning it through 180) gives another solution,
+        as long as the clues are where they were. For each such symmetry, only allow the solution whose
+        square codes, read in order, are no greater than those of its reflection.
+        """
+        x1, y1 = min(x for x, y in self.space), min(y for x, y in self.space)
+        x2, y2 = max(x for x, y in self.space), max(y for x, y in self.space)
+        symmetries = [
+            lambda x, y: (x1 + x2 - x, y),
+            lambda x, y: (x, y1 + y2 - y),
+            lambda x, y: (x1 + x2 - x, y1 + y2 - y)
+        ]
+        order = sorted(self.space)
+        symmetries = [
+            sigma for sigma in symmetries
+            if all(sigma(*xy) in self.space and self.space[sigma(*xy)] == self.space[xy] for xy in order)
+        ]
+        if not symmetries:
+            return
+        # The code of a square is (fix index * 2 + head) of the half on it: as a square has exactly one half,
+        # that is just the sum of the codes of its halves, weighted by their booleans.
+        codes = {xy: [] for xy in self.space}
+        for i, ab in enumerate(self.fixes):
+            for f, halves in enumerate([self.tails, self.heads]):
+                for xy, var in halves[ab].items():
+                    codes[xy].append((i * 2 + f, var))
+        code = {
+            xy: cp_model.LinearExpr.WeightedSum([var for c, var in vals], [c for c, var in vals])
+            for xy, vals in codes.items()
+        }
+        for sigma in symmetries:
+            # v <= w lexicographically: while all before are equal, each must be no greater than its reflection.
+            equal = self.model.NewConstant(1)
+            for xy in order:
+                v, w = code[xy], code[sigma(*xy)]
+                self.model.Add(v <= w).OnlyEnforceIf(equal)
+                same = self.model.NewBoolVar('')
+                self.model.Add(v == w).OnlyEnforceIf(same)
+                self.model.Add(v != w).OnlyEnforceIf(same.Not())
+                still_equal = self.model.NewBoolVar('')
+                self.model.AddBoolOr([equal.Not(), same.Not(), still_equal])
+                self.model.AddImplication(still_equal, equal)
+                self.model.AddImplication(still_equal, same)
+                equal = still_equal
 
     def setup(self):
         self.set_circuit()
         self.set_placements()
+        self.set_symmetry()
+
+    def set_hints(self):
+        """
+        Solve a relaxation - just the tiling: each domino placed once, against the clues, with its halves adjacent,
+        but with no chain between the dominoes - and hint the result into the full model.
+        """
+        relaxed = cp_model.CpModel()
+        fixes = {ab: relaxed.NewBoolVar('') for ab in self.fixes}
+        heads = {ab: {xy: relaxed.NewBoolVar('') for xy in cells} for ab, cells in self.heads.items()}
+        tails = {ab: {xy: relaxed.NewBoolVar('') for xy in cells} for ab, cells in self.tails.items()}
+        by_domino = defaultdict(list)
+        for fix in self.graph:
+            by_domino[fix.domino].append(fixes[fix.head])
+        for domino_fixes in by_domino.values():
+            relaxed.AddExactlyOne(domino_fixes)
+        halves_at = {xy: [] for xy in self.space}
+        for ab, fix in fixes.items():
+            relaxed.AddExactlyOne(list(heads[ab].values()) + [fix.Not()])
+            relaxed.AddExactlyOne(list(tails[ab].values()) + [fix.Not()])
+            for xy, head in heads[ab].items():
+                relaxed.AddBoolOr([tails[ab][ij] for ij in self.neighbors[xy] if ij in tails[ab]]).OnlyEnforceIf(head)
+                halves_at[xy].append(head)
+            for xy, tail in tails[ab].items():
+                halves_at[xy].append(tail)
+        for halves in halves_at.values():
+            relaxed.AddExactlyOne(halves)
 
-    def solve(self, find_all: bool = False) -> bool:
         cp_solver = cp_model.CpSolver()
-        if not find_all:
+        cp_solver.parameters.num_search_workers = 12
+        if cp_solver.Solve(relaxed) in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            self.model.ClearHints()
+            for ab, fix in fixes.items():
+                self.model.AddHint(self.fixes[ab], cp_solver.BooleanValue(fix))
+                for relaxed_halves, halves in ((heads, self.heads), (tails, self.tails)):
+                    for xy, var in relaxed_halves[ab].items():
+                        self.model.AddHint(halves[ab][xy], cp_solver.BooleanValue(var))
+
+    def solve(self, find_all: bool = False, hint: bool = False, **solver_params) -> bool:
+        """
+        Any solver_params (eg. log_search_progress=True, linearization_level=2) are set on the solver's
+        parameters last, so they override the defaults here.
+        """
+        if hint:
+            self.set_hints()
+        cp_solver = cp_model.CpSolver()
+        solution_manager = SolutionManager((self.tails, self.heads), self.fixes)
+        if find_all:
+            # Enumeration is only complete with a single worker: parallel workers skip solutions.
+            cp_solver.parameters.enumerate_all_solutions = True
+            cp_solver.parameters.num_search_workers = 1
+        else:
             cp_solver.parameters.num_search_workers = 12
-        solution_manager = SolutionManager(self.place)
+            cp_solver.parameters.symmetry_level = 2
+        for name, value in solver_params.items():
+            setattr(cp_solver.parameters, name, value)
         if find_all:
-            self.status = cp_solver.SearchForAllSolutions(self.model, solution_manager)
+            self.status = cp_solver.Solve(self.model, solution_manager)
         else:
             self.status = cp_solver.Solve(self.model)
             solution_manager.on_solution_callback(cp_solver)
@@ -321,6 +461,20 @@ class DominoBraneSolver:
             return False
 
 
+class Fix:
+    """
+     One fix (orientation) of a domino, as a node of the digraph.
+     There are a lot of these for the larger sets, so keep them slim.
+    """
+    __slots__ = ('domino', 'head', 'tails', 'tail_vars')
+
+    def __init__(self, domino: tuple, head: tuple, tails: list):
+        self.domino = domino
+        self.head = head
+        self.tails = tails
+        self.tail_vars = []
+
+
 class DominoDigraph:
     """
         28 Dominoes - 0:0 to 6:6
@@ -336,18 +490,16 @@ class DominoDigraph:
         dominoes = set((x, y) for y in range(size+1) for x in range(y, size+1))
         # fix the rotations and store against each master
         fixed = {(a, b): {(a, b), (b, a)} for (a, b) in dominoes}
+        # index every fix by the number at its 'a' end, which is what a head must match.
+        by_head = {}
+        for o, o_fixes in fixed.items():
+            for o_fix in o_fixes:
+                by_head.setdefault(o_fix[0], []).append((o, o_fix))
         # for each Domino; for each of it's fix; find those fixes from the Other dominoes which are potential tails.
-        self.graph = {
-            d: {
-                'fixes': {
-                    d_fix: {   # connect the other(o) potential dominoes as tails to each fix
-                        'tails': [
-                            o_fix for o, o_fixes in fixed.items() if o != d for o_fix in o_fixes if o_fix[0] == d_fix[1]
-                        ]
-                    } for d_fix in d_fixes
-                }
-             } for d, d_fixes in fixed.items()
-        }
+        self.graph = [
+            Fix(d, d_fix, [o_fix for o, o_fix in by_head[d_fix[1]] if o != d])
+            for d, d_fixes in fixed.items() for d_fix in d_fixes
+        ]
 
 
 class Space:
@@ -357,10 +509,10 @@ class Space:
             self.space = {(x, y): None for y in range(sy) for x in range(sx)}
 
 
-def solve(graph, space, find_all=False):
+def solve(graph, space, find_all=False, hint=False, **solver_params):
     solver = DominoBraneSolver(graph, space)
     solver.setup()
-    solver.solve(find_all)
+    solver.solve(find_all, hint, **solver_params)
 
 
 def solve_domino_digraph(scale):
@@ -31,28 +31,13 @@ from ortools.sat.python import cp_model
 
 class SolutionPrinter(cp_model.CpSolverSolutionCallback):
 
-    def __init__(self, arcs, revs):
+    def __init__(self):
         cp_model.CpSolverSolutionCallback.__init__(self)
-        self.arcs = arcs
-        self.revs = revs
         self.solutions = 0
 
     def on_solution_callback(self):
-        # Many thousands of solutions.
+        # Many thousands of solutions, so only count them.
         self.solutions += 1
-        return True
-        result = []
-        used = [arc for arc in self.arcs if self.Value(arc[2]) and arc[0] != arc[1]]
-        arc = used[0]
-        while arc:
-            used.remove(arc)
-            result.append(self.revs[arc[0]])
-            arc = next((link for link in used if link[0] == arc[1]), None)
-        if len(set(result)) != len(result):
-            print('duplicates found!')
-        if used:
-            result.append(['unused:', used])
-        print(f"{' '.join([str(x) for x in result])}")
 
 
 class DiGraphSolver:
@@ -105,8 +90,11 @@ class DiGraphSolver:
 
     def solve(self) -> bool:
         cp_solver = cp_model.CpSolver()
-        solution_printer = SolutionPrinter(self.arcs, self.rev)
-        self.status = cp_solver.SearchForAllSolutions(self.model, solution_printer)
+        # Enumerating every solution needs a single worker.
+        cp_solver.parameters.enumerate_all_solutions = True
+        cp_solver.parameters.num_search_workers = 1
+        solution_printer = SolutionPrinter()
+        self.status = cp_solver.Solve(self.model, solution_printer)
         return self.summarise(cp_solver, solution_printer.solutions)
 
     def summarise(self, cp_solver, solutions: int) -> bool:
@@ -132,21 +120,41 @@ class DominoDigraph:
         The loop is closed, no dominoes are optional.
     """
 
-    def __init__(self, size: int):
+    def __init__(self, size: int, graph: dict = None):
+        if graph is not None:
+            # already worked out (see restricted)
+            self.graph = graph
+            return
         # the primary objects
         dominoes = set((x, y) for y in range(size + 1) for x in range(y, size + 1))
         # fix the rotations and store against each master
         fixed = {(a, b): {(a, b), (b, a)} for (a, b) in dominoes}
+        # index every fix by the number at its 'a' end, which is what a head must match.
+        by_head = {}
+        for o, o_fixes in fixed.items():
+            for o_fix in o_fixes:
+                by_head.setdefault(o_fix[0], []).append((o, o_fix))
         # for each Domino; for each of it's fix; find those fixes from the Other dominoes which are potential tails.
         self.graph = {
             d: {
                 d_fix: [  # connect the other(o) potential dominoes as tails to each fix
-                    o_fix for o, o_fixes in fixed.items() if o != d for o_fix in o_fixes if o_fix[0] == d_fix[1]
+                    o_fix for o, o_fix in by_head[d_fix[1]] if o != d
                 ] for d_fix in d_fixes
             } for d, d_fixes in fixed.items()
         }
         everything = True
 
+    def restricted(self, size: int):
+        """
+        The digraph of a smaller set of dominoes is just this one without any fix that has a number over size,
+        so it can be filtered out of this one rather than worked out again.
+        """
+        return DominoDigraph(size, {
+            d: {
+                d_fix: [t for t in tails if max(t) <= size] for d_fix, tails in fixes.items()
+            } for d, fixes in self.graph.items() if max(d) <= size
+        })
+
 
 def solve(problem):
     solver = DiGraphSolver(problem)
@@ -156,9 +164,11 @@ def solve(problem):
 
 def solve_domino_digraph():
     #  2, 4, 6
-    for n in [2, 4, 6, 7, 8, 9, 10, 11, 12]:
+    scales = [2, 4, 6, 7, 8, 9, 10, 11, 12]
+    largest = DominoDigraph(max(scales))
+    for n in scales:
         print(f'trying {n}...')
-        problem = DominoDigraph(n)
+        problem = largest.restricted(n)
         solve(problem)
 
 
@@ -1,98 +1,62 @@
 import timeit
 
+import numpy as np
 from ortools.sat.python import cp_model
-from enum import IntFlag
-import random
 
-class Com(IntFlag):
-    # These values are strongly tied the order of items in Wall.concrete.
-    W = 0x0001
-    E = 0x0002
-    N = 0x0004
-    S = 0x0008
+# The compass points, as plain int bit flags.
+# These values are strongly tied the order of items in Wall.concrete.
+W = 0x0001
+E = 0x0002
+N = 0x0004
+S = 0x0008
+COMPASS = (W, E, N, S)
+
+# Where the wall on each side of a cell is kept in the maze's wall arrays, as (axis, dx, dy) from the cell.
+# Axis 0 holds the walls dividing N from S, and axis 1 those dividing E from W.
+# The order (N, S, E, W) is the order in which a cell lists its walls.
+WALL_OF = {N: (0, 0, 1), S: (0, 0, 0), E: (1, 1, 0), W: (1, 0, 0)}
+STEP = {N: (0, 1), S: (0, -1), E: (1, 0), W: (-1, 0)}
+FACING = {offs: com for com, offs in STEP.items()}
 
 class Wall:
     concrete = [' ', '╸', '╺', '━', '╹', '┛', '┗', '┻', '╻', '┓', '┏', '┳', '┃', '┫', '┣', '╋']
 
-    def __init__(self, n_s: bool, dim):
+    def __init__(self, maze, n_s: bool, dim):
+        # The state of the wall lives in the maze's arrays: this is just a view on it, for printing.
+        self.maze = maze
         self.dim = dim
-        self.blocked = False
-        self.door = False
-        self.route = False
-        self.cells = {com: None for com in Com}
         self.n_s = n_s   # dividing NS => True, dividing EW => False
 
-    def make_door(self, cell_dir):
-        other = self.cells[cell_dir]
-        if not self.blocked and other:
-            other.mined = True
-            self.door = True
-            return other
-        else:
-            return None
-
-    def set_cell(self, cell, com_from):
-        # the other cell is saying '(self) is what i see in the north'
-        # therefore the other is in the south of (self).
-        opposite = {Com.W: Com.E, Com.E: Com.W, Com.N: Com.S, Com.S: Com.N}
-        self.cells[opposite[com_from]] = cell
-
-    def is_edge(self):  # If on the edge, then one of my wall cells will be None.
-        if self.n_s:
-            return (self.cells[Com.N] is None) or (self.cells[Com.S] is None)
-        else:
-            return (self.cells[Com.W] is None) or (self.cells[Com.E] is None)
-
-    def can_be_dug(self, com_to):
-        cell = self.cells[com_to]
-        return not self.blocked and cell and not cell.mined
-
     def __str__(self):
-        if self.door:
-            return ' ' if not self.route else '.'
-        return str(Wall.concrete[Com.E | Com.W]) if self.n_s else str(Wall.concrete[Com.N | Com.S])
+        idx = (0 if self.n_s else 1, *self.dim)
+        if self.maze.door[idx]:
+            return ' ' if not self.maze.route[idx] else '.'
+        return str(Wall.concrete[E | W]) if self.n_s else str(Wall.concrete[N | S])
 
 class Cell:
     last = None
-    last_mined = None
 
-    def __init__(self, walls):
-        self.visited = False
+    def __init__(self, maze, x, y):
+        # As for walls, the mined/visited state lives in the maze's arrays.
+        self.maze = maze
+        self.x = x
+        self.y = y
         self.is_entry = False
         self.is_goal = False
-        self.mined = False
-        self.walls = walls
-        for com, wall in self.walls.items():
-            wall.set_cell(self,com)
 
-    def exits(self):
-        return [k for k, v in self.walls.items() if v and v.door]
+    def wall(self, com):
+        axis, dx, dy = WALL_OF[com]
+        return axis, self.x + dx, self.y + dy
 
     def neighbours(self):
-        faces = {Com.N: (0, 1), Com.E: (1, 0), Com.S: (0, -1), Com.W: (-1, 0)}
-        return [faces[face] for face in Com if self.walls[face] and self.walls[face].door]
+        door = self.maze.door
+        return [STEP[face] for face in COMPASS if door[self.wall(face)]]
 
     def route_to(self, offs):
-        routes = {(0, 1): Com.N, (1, 0): Com.E,(0, -1): Com.S, (-1, 0): Com.W}
-        self.walls[routes[offs]].route = True
-
-    def walls_that_can_be_dug(self):
-        return [compass for compass, wall in self.walls.items() if wall.can_be_dug(compass)]
-
-    def make_door_in(self, com):
-        cell = self.walls[com].make_door(com)
-        if cell:
-            Cell.last_mined = cell
-        return cell
-
-    def visit(self, face: Com, move: bool = False):
-        # Returns a 3-tuple: what is ahead, the current room, if current room is the goal.
-        self.visited = True
-        destination = self.walls[face].cells[face] if move and self.walls[face].door else self
-        return destination.walls[face].door, destination, destination.is_goal
+        self.maze.route[self.wall(FACING[offs])] = True
 
     def __str__(self):
-        return "." if self.visited else "*" if self.is_goal else "o" if self.is_entry else " "
+        return "." if self.maze.visited[self.x, self.y] else "*" if self.is_goal else "o" if self.is_entry else " "
 
 class Maze:
     def __init__(self, x, y):
@@ -101,55 +65,81 @@ class Maze:
         self.x = x
         self.y = y
 
-        self.ns_walls = { (i,j): Wall(True,  (i, j)) for j in range(y + 1) for i in range(x) }
-        self.ew_walls = { (i,j): Wall(False, (i, j)) for j in range(y) for i in range(x + 1) }
-        self.cells = { (i,j): Cell(self._cell_walls(i, j)) for i in range(x) for j in range(y)}
+        # The maze's state is kept as arrays, rather than spread over thousands of small objects.
+        # Walls are [axis, i, j]: axis 0 is the NS wall below cell (i, j), axis 1 is the EW wall to its west.
+        self.blocked = np.zeros((2, x + 1, y + 1), dtype=bool)
+        self.door = np.zeros((2, x + 1, y + 1), dtype=bool)
+        self.route = np.zeros((2, x + 1, y + 1), dtype=bool)
+        # dug is padded by one all round, with the outside marked as dug so that nobody digs into it.
+        self.dug = np.ones((x + 2, y + 2), dtype=bool)
+        self.dug[1:-1, 1:-1] = False
+        self.visited = np.zeros((x, y), dtype=bool)
+
+        self.ns_walls = { (i,j): Wall(self, True,  (i, j)) for j in range(y + 1) for i in range(x) }
+        self.ew_walls = { (i,j): Wall(self, False, (i, j)) for j in range(y) for i in range(x + 1) }
+        self.cells = { (i,j): Cell(self, i, j) for i in range(x) for j in range(y)}
 
     def mine(self, bod):
         while not bod.finished():
             bod.run()
             self.mined = True
 
-    def _cell_walls(self, x, y):
-        return {
-            Com.N: self.ns_walls[x, y + 1] if (x, y + 1) in self.ns_walls else None,
-            Com.S: self.ns_walls[x,     y] if (x,     y) in self.ns_walls else None,
-            Com.E: self.ew_walls[x + 1, y] if (x + 1, y) in self.ew_walls else None,
-            Com.W: self.ew_walls[x,     y] if (x,     y) in self.ew_walls else None
-        }
-
-    def _corners(self, x, y) -> str:
-        found = {
-            Com.N: self.ew_walls[x, y - 1] if (x, y - 1) in self.ew_walls else None,
-            Com.S: self.ew_walls[x,     y] if (x,     y) in self.ew_walls else None,
-            Com.E: self.ns_walls[x,     y] if (x,     y) in self.ns_walls else None,
-            Com.W: self.ns_walls[x - 1, y] if (x - 1, y) in self.ns_walls else None
-        }
-        value = sum([com for com, wall in found.items() if wall and not wall.door])
-        return str(Wall.concrete[value])
+    def _corners(self):
+        # The bitmask (W, E, N, S) of solid walls meeting at every corner, as an (x+1, y+1) array.
+        # Walls beyond the edge of the maze are padded in as open, so every corner can be read the same way.
+        x, y = self.x, self.y
+        ns = np.zeros((x + 2, y + 1), dtype=np.uint8)
+        ns[1:-1] = ~self.door[0, :x]
+        ew = np.zeros((x + 1, y + 2), dtype=np.uint8)
+        ew[:, 1:-1] = ~self.door[1, :, :y]
+        return ns[:-1] * W | ns[1:] * E | ew[:, :-1] * N | ew[:, 1:] * S
 
     def __str__(self):  # __str__ method here is just for easy visualisation purposes.
-        line = ''
+        # Build every wall, corner and cell as a character up front, then join them row by row.
+        corners = np.array(Wall.concrete)[self._corners()].tolist()
+        ns = np.where(self.door[0], np.where(self.route[0], '.', ' '), Wall.concrete[E | W]).tolist()
+        ew = np.where(self.door[1], np.where(self.route[1], '.', ' '), Wall.concrete[N | S]).tolist()
+        rooms = np.where(self.visited, '.', ' ').tolist()
+        for cell in self.cells.values():
+            if (cell.is_goal or cell.is_entry) and not self.visited[cell.x, cell.y]:
+                rooms[cell.x][cell.y] = str(cell)
+        parts = []
         for j in range(self.y + 1):  # reversed: print goes from top to bottom..
-            line_ns = ""
-            line_ew = ""
-            for i in range(self.x + 1):
-                line_ns += str(self._corners(i, j))
-                if (i, j) in self.ns_walls:
-                    line_ns += str(self.ns_walls[i, j])
-                if (i, j) in self.ew_walls:
-                    line_ew += str(self.ew_walls[i, j])
-                if (i, j) in self.cells:
-                    line_ew += str(self.cells[i, j])
-            line += line_ns + "\n" + line_ew + "\n"
-        return line
+            for i in range(self.x):
+                parts.append(corners[i][j])
+                parts.append(ns[i][j])
+            parts.append(corners[self.x][j])
+            parts.append("\n")
+            if j < self.y:
+                for i in range(self.x):
+                    parts.append(ew[i][j])
+                    parts.append(rooms[i][j])
+                parts.append(ew[self.x][j])
+            parts.append("\n")
+        return "".join(parts)
 
 class Miner:
-    def __init__(self, start):
-        self.track = [start]
+    # Each way a miner can dig from a cell: (compass, wall axis, wall dx, wall dy, cell dx, cell dy),
+    # with the cell offsets shifted by one to index the maze's padded dug array.
+    ways = tuple((com, *WALL_OF[com], STEP[com][0] + 1, STEP[com][1] + 1) for com in WALL_OF)
+
+    def __init__(self, start, seed=None):
+        # The miner works on the maze's arrays directly, so it tracks cells as (x, y).
+        self.track = [(start.x, start.y)]
+        # The start is dug from the outset, so that no other cell can break back into it.
+        start.maze.dug[start.x + 1, start.y + 1] = True
         self.is_miner = True
         self.sequence = 0
         self.forward = 0
+        # Random numbers are drawn from numpy in batches, and used up one at a time.
+        self.rng = np.random.default_rng(seed)
+        self.randoms = []
+
+    def _random(self, n: int) -> int:
+        # A random index in range(n).
+        if not self.randoms:
+            self.randoms = self.rng.random(4096).tolist()
+        return int(self.randoms.pop() * n)
 
     def dig(self, the_maze):
         if not self.track:
@@ -161,30 +151,37 @@ class Miner:
             while self.track and the_wall is None:
                 if self.sequence & 15 != 0:  # cheaper than % 16
                     this_cell = self.track[-1]
-                    walls_to_dig = this_cell.walls_that_can_be_dug()
-                    if walls_to_dig:
-                        the_wall = self.mine(walls_to_dig, this_cell)
+                    ways_to_dig = self.ways_to_dig(the_maze, this_cell)
+                    if ways_to_dig:
+                        the_wall = self.mine(the_maze, ways_to_dig, this_cell)
                     else:
                         self.forward = 0
                         self.track.pop()
                 else:
                     self.forward = 0
-                    cell_index = random.randrange(len(self.track))
+                    cell_index = self._random(len(self.track))
                     this_cell = self.track[cell_index]
-                    walls_to_dig = this_cell.walls_that_can_be_dug()
-                    if walls_to_dig:
-                        the_wall = self.mine(walls_to_dig, this_cell)
+                    ways_to_dig = self.ways_to_dig(the_maze, this_cell)
+                    if ways_to_dig:
+                        the_wall = self.mine(the_maze, ways_to_dig, this_cell)
                     else:
                         del self.track[cell_index]
 
-    def mine(self, walls_to_dig, this_cell):
-        the_wall = random.choice(walls_to_dig)
-        next_cell = this_cell.make_door_in(the_wall)
-        if next_cell:
-            self.track.append(next_cell)
-            self.forward += 1
-        else:
-            the_wall = None
+    def ways_to_dig(self, the_maze, cell):
+        x, y = cell
+        blocked, dug = the_maze.blocked, the_maze.dug
+        return [
+            way for way in self.ways
+            if not dug[x + way[4], y + way[5]] and not blocked[way[1], x + way[2], y + way[3]]
+        ]
+
+    def mine(self, the_maze, ways_to_dig, cell):
+        the_wall, axis, dx, dy, sx, sy = ways_to_dig[self._random(len(ways_to_dig))]
+        x, y = cell
+        the_maze.door[axis, x + dx, y + dy] = True
+        the_maze.dug[x + sx, y + sy] = True
+        self.track.append((x + sx - 1, y + sy - 1))
+        self.forward += 1
         return the_wall
 
 def solve(maze: Maze, start, goal):
@@ -196,18 +193,42 @@ def solve(maze: Maze, start, goal):
     i_to_n = {idx: pos for idx, pos in enumerate(maze.cells)}
     n_to_i = {pos: idx for idx, pos in enumerate(maze.cells)}
     doors = {}
+    arcs_in = {idx: [] for idx in i_to_n}
+    arcs_out = {idx: [] for idx in i_to_n}
     for head, (nx, ny) in i_to_n.items():
         # neighbours are given as dx/dy because a cell doesn't hold it's own coordinate.
+        # Each door is seen from both of its cells, so it gets an arc in each direction.
         for (dx, dy) in maze.cells[nx, ny].neighbours():
             tail = n_to_i[nx + dx, ny + dy]
-            doors[(nx, ny), (dx, dy)] = (head, tail, model.NewBoolVar(f'{head}:{tail}'))
-    loops = [(head, head, model.NewBoolVar(f'{head}')) for head in i_to_n if head not in {n_to_i[start], n_to_i[goal]}]
-    tie = [(n_to_i[goal], n_to_i[start], model.NewBoolVar(f'loop'))]
-    model.AddCircuit(list(doors.values()) + loops + tie)
+            door = model.NewBoolVar(f'{head}:{tail}')
+            doors[(nx, ny), (dx, dy)] = (head, tail, door)
+            arcs_out[head].append(door)
+            arcs_in[tail].append(door)
+
+    # A path rather than a circuit: flow is conserved through every cell except the two ends,
+    # one arc leaves the start and one arc enters the goal.
+    # Any detour or isolated loop costs arcs, so the shortest route is the only optimum.
+    source, sink = n_to_i[start], n_to_i[goal]
+    for idx in i_to_n:
+        if idx == source:
+            model.Add(sum(arcs_out[idx]) == 1)
+            model.Add(sum(arcs_in[idx]) == 0)
+        elif idx == sink:
+            model.Add(sum(arcs_in[idx]) == 1)
+            model.Add(sum(arcs_out[idx]) == 0)
+        else:
+            model.Add(sum(arcs_in[idx]) == sum(arcs_out[idx]))
+    arcs = [door for (_, _, door) in doors.values()]
+    model.Minimize(sum(arcs))
+    # Trying each door as unused first lets the search drop dead ends straight away.
+    model.AddDecisionStrategy(arcs, cp_model.CHOOSE_FIRST, cp_model.SELECT_MIN_VALUE)
 
     solver = cp_model.CpSolver()
     solver.parameters.max_time_in_seconds = 1
-    solver.parameters.num_search_workers = 12
+    # The model is small and purely boolean: start-up and LP work cost more than the search does.
+    solver.parameters.num_search_workers = 4
+    solver.parameters.linearization_level = 0
+    solver.parameters.cp_model_probing_level = 0
     if summarise(solver, solver.Solve(model)):
         for (cell, offset), (h, t, door) in doors.items():
             if solver.Value(door):
@@ -226,20 +247,45 @@ def summarise(solver: cp_model.CpSolver, status) -> bool:
         return False
 
 class Crawler:
+    # Facing is kept as 0..3, going clockwise from N, so turning is just adding or subtracting 1 (mod 4).
+    faces = (N, E, S, W)
+    steps = tuple(STEP[face] for face in faces)
+
     def __init__(self, start: Cell):
-        self.cw = {Com.E: Com.S, Com.S: Com.W, Com.W: Com.N, Com.N: Com.E}
-        self.ccw = {Com.E: Com.N, Com.S: Com.E, Com.W: Com.S, Com.N: Com.W}
+        self.maze = start.maze
         self.cell = start      # don't know much about this.
-        self.facing = Com.E         # start..
+        self.facing = E         # start..
         self.arrived = False
 
     def solve(self):
-        while not self.arrived:
-            if self.cw[self.facing] in self.cell.exits():
-                self.facing = self.cw[self.facing]
-                can_move, self.cell, self.arrived = self.cell.visit(self.facing, True)
+        if self.arrived:
+            return
+        # Each cell's doors as a bitmask, with bit f set if there is a door when facing f.
+        door = self.maze.door
+        x, y = self.maze.x, self.maze.y
+        masks = (
+            door[0, :x, 1:] | door[1, 1:, :y] << 1 | door[0, :x, :y] << 2 | door[1, :x, :y] << 3
+        ).tolist()
+        goals = {(c.x, c.y) for c in self.maze.cells.values() if c.is_goal}
+        visited = self.maze.visited
+        steps = self.steps
+        f = self.faces.index(self.facing)
+        cx, cy = self.cell.x, self.cell.y
+        while True:
+            cw = (f + 1) & 3
+            if masks[cx][cy] >> cw & 1:
+                f = cw
+                visited[cx, cy] = True
+                dx, dy = steps[f]
+                cx += dx
+                cy += dy
+                if (cx, cy) in goals:
+                    break
             else:
-                self.facing = self.ccw[self.facing]
+                f = (f - 1) & 3
+        self.facing = self.faces[f]
+        self.cell = self.maze.cells[cx, cy]
+        self.arrived = True
 
 
 if __name__ == '__main__':
@@ -22,11 +22,13 @@
 
     This will generate obj/mtl 3D 'Wavefront' files of the solution.
 """
+import hashlib
+import os
 import sys
+from itertools import permutations, product
 import numpy as np
 from ortools.sat.python import cp_model
 import open3d as o3d
-import copy
 
 class PolycubePuzzleSolver:
     def __init__(self):
@@ -37,23 +39,102 @@ class PolycubePuzzleSolver:
         self.solver.parameters.num_search_workers = 12
         self.pieces = None
         self.space = None
+        self.space_min = None
+        self.space_pts = None
+        self.space_mask = None
         self.pos_items = None
         self.presence = {}
         self.result = None
 
     @staticmethod
-    def _translate(fixed, offs: tuple) -> set:
+    def _translate(fixed, offsets: np.ndarray) -> list:
         """
-            return the normalised block translated by offset (x,y,z).
+            return the normalised block translated by each of the offsets (x,y,z), as a list of point lists.
         """
-        return {tuple((pt[0] + offs[0], pt[1] + offs[1], pt[2] + offs[2])) for pt in fixed}
+        return (offsets[:, None, :] + np.asarray(fixed)[None, :, :]).tolist()
 
-    def legal(self, fixed, offs: tuple) -> bool:
-        for pt in fixed:
-            xyz = pt[0] + offs[0], pt[1] + offs[1], pt[2] + offs[2]
-            if xyz not in self.space:
-                return False
-        return True
+    def legal(self, fixed) -> np.ndarray:
+        """
+            return all the offsets (x,y,z) in the space at which the normalised block lies wholly in the space.
+            Offsets which would put the block's bounding box past the far sides of the space are never tried.
+        """
+        fits = (self.space_pts + np.max(fixed, axis=0) < self.space_mask.shape).all(axis=1)
+        candidates = self.space_pts[fits]
+        xs, ys, zs = candidates.T
+        inside = np.logical_and.reduce([self.space_mask[xs + x, ys + y, zs + z] for (x, y, z) in fixed])
+        return candidates[inside] + self.space_min
+
+    def _set_space_mask(self):
+        """
+            Hold the space as an array of points, relative to its minimum corner, and as a bool mask of those points.
+        """
+        points = np.array(sorted(self.space))
+        self.space_min = points.min(axis=0)
+        self.space_pts = points - self.space_min
+        self.space_mask = np.zeros(self.space_pts.max(axis=0) + 1, dtype=bool)
+        self.space_mask[tuple(self.space_pts.T)] = True
+
+    @staticmethod
+    def _orient(pts, perm, signs) -> tuple:
+        """
+            return the points, with their axes permuted and signed, brought back to the origin and sorted.
+        """
+        moved = np.asarray(pts)[:, perm] * signs
+        moved -= moved.min(axis=0)
+        return tuple(map(tuple, moved[np.lexsort(moved.T[::-1])].tolist()))
+
+    def symmetries(self, pieces: dict, available: dict) -> list:
+        """
+            return each (perm, signs) of the 48 rotations and reflections which maps the space onto itself,
+            and maps the pieces in use onto pieces with the same allowance (a reflection swaps a piece with its mirror).
+            Each is given with the piece that it maps each piece to. The identity is left out.
+        """
+        space = self._orient(self.space_pts, [0, 1, 2], 1)
+        shapes = {name: {tuple(map(tuple, fixed['pts'])) for fixed in pieces[name].fixed.values()} for name in available}
+        actions = {self.space_pts.tobytes()}
+        found = []
+        for perm, signs in product(permutations(range(3)), product((1, -1), repeat=3)):
+            moved = self.space_pts[:, perm] * signs
+            moved -= moved.min(axis=0)
+            action = moved.tobytes()
+            if action in actions or self._orient(moved, [0, 1, 2], 1) != space:
+                continue
+            actions.add(action)
+            images = {}
+            for name in available:
+                image = self._orient(pieces[name].fixed[0]['pts'], perm, signs)
+                images[name] = next((other for other in available if image in shapes[other]), None)
+            if all(other is not None and available[other] == available[name] for name, other in images.items()):
+                found.append((list(perm), np.array(signs), images))
+        return found
+
+    def set_symmetry(self, model, pieces: dict, available: dict):
+        """
+            Solutions that are rotations or reflections of each other (through symmetries of the space) are all
+            the same solution. Pick a piece that is used exactly once and is its own image under the symmetries,
+            rank its placements, and insist that it is placed no later than any image of that placement.
+            This is the lex-leader rule, applied to just the one piece.
+        """
+        symmetries = self.symmetries(pieces, available)
+        singles = [name for name, allowed in available.items() if allowed == 1]
+        if not symmetries or not singles:
+            return
+        name = max(singles, key=lambda n: sum(images[n] == n for _, _, images in symmetries))
+        keys = sorted(key for key in self.presence if key[0] == name)
+        rank = {key: r for r, key in enumerate(keys)}
+        at = {frozenset(map(tuple, (np.asarray(pieces[name].fixed[i]['pts']) + offset).tolist())): (name, i, offset)
+              for (_, i, offset) in keys}
+        for perm, signs, images in symmetries:
+            if images[name] != name:
+                continue
+            moved = self.space_pts[:, perm] * signs
+            shift = self.space_min - moved.min(axis=0)
+            image_rank = {}
+            for pts, key in at.items():
+                image = (np.array(list(pts)) - self.space_min)[:, perm] * signs + shift
+                image_rank[key] = rank[at[frozenset(map(tuple, image.tolist()))]]
+            model.Add(sum(rank[key] * self.presence[key] for key in keys) <=
+                      sum(image_rank[key] * self.presence[key] for key in keys))
 
     def process(self, pieces: dict, problem: dict):
         """
@@ -73,31 +154,30 @@ class PolycubePuzzleSolver:
         """
         For each fixed piece that's being used...
         See if it can be placed at each point in space, and if so, add it into the model as a potential presence
-        of the solution. Also add it's coordinates into a placement dict so that we can test for overlaps later.
+        of the solution. At the same time, compose pos_items - this is the set of all points of each possible piece
+        at each x,y,z in the space. We will use this for constraint setting and for rendering.
         """
-        placement = {}
+        self.pos_items = {x: set() for x in self.space}
+        self._set_space_mask()
         for name, piece in pieces.items():
             if name in available:
-                for offset in self.space:
-                    for i, fixed in piece.fixed.items():
-                        if self.legal(fixed['pts'], offset):
-                            self.presence[tuple((name, i, offset))] = model.NewBoolVar(f"{name}_{i}:{offset}")
-                            placement[tuple((name, i, offset))] = self._translate(fixed['pts'], offset)
+                for i, fixed in piece.fixed.items():
+                    offsets = self.legal(fixed['pts'])
+                    for offset, pts in zip(map(tuple, offsets.tolist()), self._translate(fixed['pts'], offsets)):
+                        key = (name, i, offset)
+                        self.presence[key] = model.NewBoolVar(f"{name}_{i}:{offset}")
+                        for point in map(tuple, pts):
+                            self.pos_items[point].add(key)
 
         """
-        Compose free - the entire set of fixed+offset pieces by each 'free' piece (eg, the set of all "K")
+        Rule out solutions which are just rotations or reflections of others.
         """
-        free = {k: [bv for i, bv in self.presence.items() if i[0] == k] for k in available}
+        self.set_symmetry(model, pieces, available)
 
         """
-        Compose pos_items - this is the set of all points of each possible piece at each x,y,z in the space.
-        We will use this for constraint setting and for rendering.
+        Compose free - the entire set of fixed+offset pieces by each 'free' piece (eg, the set of all "K")
         """
-        self.pos_items = {x: set() for x in self.space}
-        for fixed, p_bv in self.presence.items():
-            pp = placement[fixed]
-            for point in pp:
-                self.pos_items[point].add(fixed)
+        free = {k: [bv for i, bv in self.presence.items() if i[0] == k] for k in available}
 
         """
         Constraints are:
@@ -106,7 +186,9 @@ class PolycubePuzzleSolver:
         """
         to_maximise = []
         for k, allowed in available.items():
-            if allowed > 0:
+            if allowed == 1:
+                model.AddExactlyOne(free[k])
+            elif allowed > 0:
                 model.Add(sum(free[k]) == allowed)
             else:
                 model.Add(sum(free[k]) >= -allowed)  # if we want at least 1, use -1
@@ -122,9 +204,9 @@ class PolycubePuzzleSolver:
         for pt_points in self.pos_items.values():
             items = [self.presence[i] for i in pt_points]
             if problem['gaps']:
-                model.Add(sum(items) <= 1)
+                model.AddAtMostOne(items)
             else:
-                model.Add(sum(items) == 1)
+                model.AddExactlyOne(items)
 
         """
         Can now solve.
@@ -158,66 +240,72 @@ class PolycubePuzzleSolver:
     def save(self, file_name: str = 'file'):
         from colorsys import hsv_to_rgb
         count = len(self.result)
-        mesh_file = '# OBJ File: {file_name}\n# Material Count: {count}\n\n'
-        material_file = '# MTL File: {file_name}\n# Mesh Count: {count}\n\n'
+        # Both files are built as lists of parts, and joined once when written.
+        mesh_file = ['# OBJ File: {file_name}\n# Material Count: {count}\n\n']
+        material_file = ['# MTL File: {file_name}\n# Mesh Count: {count}\n\n']
         for idx, thing in enumerate(self.result):
             hue = idx/count
             name = thing[0]
             r, g, b = hsv_to_rgb(hue, 1.0, 1.0)
-            material_file += f'newmtl {name}_{idx:03x}_Mat\n' \
-                     f'Ns 225.000000\n' \
-                     f'Ka 1.000000 1.000000 1.000000\n' \
-                     f'Kd {r} {g} {b}\n' \
-                     f'Ks 0.500000 0.500000 0.500000\n' \
-                     f'Ke 0.000000 0.000000 0.000000\n' \
-                     f'Ni 1.00000\n' \
-                     f'd 1.000000\n' \
-                     f'illum 2\n\n'
+            material_file.append(f'newmtl {name}_{idx:03x}_Mat\n'
+                                 f'Ns 225.000000\n'
+                                 f'Ka 1.000000 1.000000 1.000000\n'
+                                 f'Kd {r} {g} {b}\n'
+                                 f'Ks 0.500000 0.500000 0.500000\n'
+                                 f'Ke 0.000000 0.000000 0.000000\n'
+                                 f'Ni 1.00000\n'
+                                 f'd 1.000000\n'
+                                 f'illum 2\n\n')
         m = open(f'{file_name}.mtl', 'w')
-        m.write(material_file)
+        m.write(''.join(material_file))
         m.close()
 
         # although called vertex normals, we are using them on each face which is cubic, so there are six.
         normals = [[0.0000, 1.0000, 0.0000], [0.0000, -1.0000, 0.0000], [1.0000, 0.0000, 0.0000],
                    [0.0000, 0.0000, 1.0000], [0.0000, 0.0000, -1.0000], [-1.0000, 0.0000, 0.0000]]
 
-        mesh_file += f'mtllib {file_name}.mtl\n\nVertex Normals (1-6)\n'
+        mesh_file.append(f'mtllib {file_name}.mtl\n\nVertex Normals (1-6)\n')
         for x, y, z in normals:
-            mesh_file += f"vn  {x} {y} {z}\n"
+            mesh_file.append(f"vn  {x} {y} {z}\n")
+        normal_index = {tuple(n): i + 1 for i, n in enumerate(normals)}
 
         # points are referenced globally
         # so we need to add the sum of previous points on each model.
         pto = 1
         for idx, thing in enumerate(self.result):
             name, fix, offset = thing
-            mesh_file += f'\n# object {name} {idx:03x}\n'
-            mesh_file += f'o {name}_{idx:03x}\n'
-            model = copy.deepcopy(self.pieces[name].fixed[fix]['model'])
-            model.translate(offset)
-
-            points = list(model.vertices)
-            mesh_file += f'\n#object vertices\n'
+            mesh_file.append(f'\n# object {name} {idx:03x}\n')
+            mesh_file.append(f'o {name}_{idx:03x}\n')
+            # The mesh is shared by every placement of this fix, so read it as arrays and move those instead.
+            model = self.pieces[name].fixed[fix]['model']
+            points = (np.asarray(model.vertices) + np.asarray(offset)).tolist()
+            mesh_file.append(f'\n#object vertices\n')
             for px, py, pz in points:
-                mesh_file += f'v {px} {py} {pz}\n'
-            mesh_file += f'\n# polygon material\n' \
-                         f'usemtl {name}_{idx:03x}_Mat\n\ns off\n'
-            faces = list(model.triangles)
-            face_normals = list(model.triangle_normals)
+                mesh_file.append(f'v {px} {py} {pz}\n')
+            mesh_file.append(f'\n# polygon material\n'
+                             f'usemtl {name}_{idx:03x}_Mat\n\ns off\n')
+            faces = np.asarray(model.triangles).tolist()
+            face_normals = list(map(tuple, np.asarray(model.triangle_normals).tolist()))
             face_count = len(faces)
-            mesh_file += f'\n#object has {face_count} triangle faces\n'
+            mesh_file.append(f'\n#object has {face_count} triangle faces\n')
             for idx in range(face_count):
                 face = faces[idx]
-                fn = 1 + normals.index(list(face_normals[idx]))
-                mesh_file += 'f '
-                for pi in face:
-                    mesh_file += f'{pto + pi}//{fn} '
-                mesh_file += '\n'
+                fn = normal_index[face_normals[idx]]
+                mesh_file.append('f ' + ''.join(f'{pto + pi}//{fn} ' for pi in face) + '\n')
             pto += len(points)
         f = open(f'{file_name}.obj', 'w')
-        f.write(mesh_file)
+        f.write(''.join(mesh_file))
         f.close()
 
+# Where Shape keeps the meshes that it has made, so that later runs can skip making them again.
+# Bump MESH_VERSION whenever the mesh construction in Shape.model changes, so that older meshes are not used.
+MESH_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'polycube', 'meshes.npz')
+MESH_VERSION = 1
+
+
 class Shape:
+    meshes = None
+    meshes_added = False
 
     def __init__(self, points: list, name: str = 'shape'):
         self.name = name
@@ -247,19 +335,57 @@ class Shape:
         ][p % 24]
 
     def fix(self, points: list):
-        # Try all 24 3D rotations on a voxel object and eliminate symmetric identities by using a hash of the result.
+        # Try all 24 3D rotations on a voxel object and eliminate symmetric identities by using the bytes of the result.
+        # All of the rotations are applied in one go, using the rotation matrices in R24.
+        pts = np.array(Shape._normalise_pts(points), dtype=np.int8)
+        rotated = np.einsum('rij,nj->rni', R24, pts)
+        rotated -= rotated.min(axis=1, keepdims=True)
         rt = dict()
-        for f in range(24):
-            ff = Shape._normalise_pts([Shape._cube_p(pt, f) for pt in Shape._normalise_pts(points)])
-            ff_str = str(ff)
-            rt[hash(ff_str)] = ff
-        self.fixed = {k: {'pts': v} for k, v in enumerate(rt.values())}
+        for f in rotated:
+            ff = f[np.lexsort(f.T[::-1])]
+            rt.setdefault(ff.tobytes(), ff)
+        self.fixed = {k: {'pts': v.tolist()} for k, v in enumerate(rt.values())}
+
+    @classmethod
+    def _mesh_cache(cls) -> dict:
+        # The cache of meshes made on previous runs, loaded once: vertices and triangles as plain arrays.
+        if cls.meshes is None:
+            try:
+                with np.load(MESH_CACHE, allow_pickle=False) as cache:
+                    cls.meshes = dict(cache)
+            except (OSError, ValueError):
+                cls.meshes = {}
+        return cls.meshes
+
+    @classmethod
+    def save_meshes(cls):
+        # Write the cache once, after all the shapes are modelled, and only if any meshes were added.
+        # It is written aside and then moved into place, so a run never sees half a file.
+        if cls.meshes_added:
+            try:
+                os.makedirs(os.path.dirname(MESH_CACHE), exist_ok=True)
+                with open(f'{MESH_CACHE}.tmp', 'wb') as cache:
+                    np.savez(cache, **cls.meshes)
+                os.replace(f'{MESH_CACHE}.tmp', MESH_CACHE)
+                cls.meshes_added = False
+            except OSError:
+                pass
 
     def model(self):
         # For each fixed rotation of this voxel shape, generate a triangular mesh.
+        # The meshes only depend on the points (and MESH_VERSION), so they are cached between runs.
+        meshes = Shape._mesh_cache()
         for key in self.fixed.keys():
             construct = self.fixed[key]
             transforms = construct['pts']  # called transforms here each is the voxel of the solid.
+            points = np.array(transforms, dtype=np.int8).tobytes()
+            code = hashlib.sha256(f'{MESH_VERSION}:'.encode() + points).hexdigest()
+            if f'{code}_v' in meshes:
+                box = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(meshes[f'{code}_v']),
+                                                o3d.utility.Vector3iVector(meshes[f'{code}_t']))
+                box.compute_triangle_normals()
+                construct['model'] = box
+                continue
             box = o3d.geometry.TriangleMesh.create_box()
             box.clear()
             for trans in transforms:
@@ -269,19 +395,22 @@ class Shape:
                 voxel.translate(trans)
                 box += voxel
             box.remove_duplicated_vertices()
-            dupes = set()
-            tr_idx = {}
-            for idx, t in enumerate(np.asarray(box.triangles)):
-                xt = tuple(sorted(list(t)))
-                if xt in tr_idx:
-                    dupes.add(tr_idx[xt])
-                    dupes.add(idx)
-                else:
-                    tr_idx[xt] = idx
-            box.remove_triangles_by_index(list(dupes))
+            # Faces shared by two voxels appear twice (in either winding), and both copies are internal: remove them.
+            tris = np.sort(np.asarray(box.triangles), axis=1)
+            _, inverse, counts = np.unique(tris, axis=0, return_inverse=True, return_counts=True)
+            dupes = np.flatnonzero(counts[inverse.reshape(-1)] > 1)
+            box.remove_triangles_by_index(dupes.tolist())
             box.remove_unreferenced_vertices()
             box.compute_triangle_normals()
             construct['model'] = box
+            meshes[f'{code}_v'] = np.array(box.vertices)
+            meshes[f'{code}_t'] = np.array(box.triangles)
+            Shape.meshes_added = True
+
+
+# The 24 rotations of _cube_p as 3x3 matrices: each column is where _cube_p sends one of the unit axes.
+R24 = np.array([[Shape._cube_p(axis, p) for axis in np.eye(3, dtype=int).tolist()] for p in range(24)],
+               dtype=np.int8).transpose(0, 2, 1)
 
 
 def main():
@@ -334,6 +463,7 @@ def main():
     problem_space.remove((2, 5, 1))
     problem_space.remove((2, 5, 3))
     problem_shapes = {name: Shape(shape, name) for name, shape in pentacubes_29.items()}
+    Shape.save_meshes()
 
     puzzle = {
         'gaps': False,
@@ -34,27 +34,51 @@ If successful, it returns a box drawing of the result, e.g. for a 3x20 grid with
     ║ ╚═╗ ╔═╩═══╩═╩═╗ ╚═══╗ ║ ║ ╔═╝ ╚═══╗ ║ ║
     ╚═══╩═╩═════════╩═════╩═╩═╩═╩═══════╩═╩═╝
 """
+import time
+import numpy as np
 from ortools.sat.python import cp_model
 
+# The parameters that every PolyominoPuzzleSolver starts from, set up once and copied into each solver in one go.
+SOLVER_PARAMS = cp_model.CpSolver().parameters
+SOLVER_PARAMS.max_time_in_seconds = 10
+SOLVER_PARAMS.symmetry_level = 2
+SOLVER_PARAMS.linearization_level = 1
+
 
 class PolyominoPuzzleSolver:
-    def __init__(self):
+    def __init__(self, **solver_params):
+        """
+        Any solver_params (eg. symmetry_level=2, linearization_level=0, cp_model_probing_level=0) are set on the
+        solver's parameters last, so they override the defaults here.
+        Unless num_search_workers is given, it is chosen by process() from the size of the model.
+        The solver may be used for several problems, by calling process() for each.
+        """
         self.allow_gaps = False
         self.maximising = False
+        self.scale = 1
         self.status = cp_model.UNKNOWN
         self.solver = cp_model.CpSolver()
-        self.solver.parameters.max_time_in_seconds = 10
-        self.solver.parameters.num_search_workers = 12
+        self.solver.parameters.copy_from(SOLVER_PARAMS)
+        self.solver_params = solver_params
+        for name, value in solver_params.items():
+            setattr(self.solver.parameters, name, value)
         self.pieces = None
         self.ground = None
         self.pos_items = None
+        self.width = 0
         self.presence = {}
+        self.placed = set()
+        self.wall_time = 0.0
 
     def process(self, pieces, problem: dict):
         """
         Given a problem and the pieces we construct a SAT model and then solve it.
+        An exact cover problem is solved by cover() instead.
         """
         model = cp_model.CpModel()
+        self.maximising = False
+        self.presence = {}
+        self.placed = set()
 
         """
         If gaps is true, a solution may include gaps.
@@ -73,30 +97,76 @@ class PolyominoPuzzleSolver:
         """
         For each lib piece that's being used (by default that's 63 - each of the 12 shapes flipped/rotated)..
         See if it can be placed at each point in space, and if so, add it into the model as a potential presence
-        of the solution. Also add it's coordinates into a placement dict so that we can test for overlaps later. 
+        of the solution. At the same time, compose pos_items - this is the list of all possible pieces covering
+        each x,y in the space, indexed by the bit of x,y in the ground (below). We will use this for constraint setting.
+        Each placement is keyed by its lib piece and the bit of its offset, and is only made once, so the lists need
+        no de-duplication.
         """
-        placement = {}
-        for named_fix in pieces.lib:
-            if named_fix[0] in available:
-                for point in self.ground:
-                    if pieces.legal(named_fix, self.ground, point):
-                        self.presence[tuple((*named_fix, point))] = model.NewBoolVar(f"{named_fix}:{point}")
-                        placement[tuple((*named_fix, point))] = pieces.translate(named_fix, point)
+        legal_pieces = [named_fix for named_fix in pieces.lib if named_fix[0] in available]
 
         """
-        Compose free - the entire set of lib+offset pieces by each 'free' piece (eg, the set of all "K")
+        Legality is tested on the ground packed into an int as a bitmask, one row of 'width' bits per y.
+        The rows are padded by the widest piece, so that a piece hanging off the right edge can't wrap onto
+        the next row. A piece fits at a point if the ground, shifted down to that point, covers its mask.
         """
-        free = {k: [bv for i, bv in self.presence.items() if i[0] == k] for k in available}
+        x0 = min(x for x, _ in self.ground)
+        y0 = min(y for _, y in self.ground)
+        x2 = max(x for x, _ in self.ground)
+        y2 = max(y for _, y in self.ground)
+        width = x2 - x0 + 1 + max(x for fix in pieces.lib.values() for x, _ in fix)
+        self.width = width
+        ground_bits = 0
+        for x, y in self.ground:
+            ground_bits |= 1 << ((y - y0) * width + x - x0)
+        shifts = [(point, (point[1] - y0) * width + point[0] - x0) for point in self.ground]
+        self.pos_items = [[] for _ in range((y2 - y0 + 1) * width)]
+        for named_fix in legal_pieces:
+            mask, cells = pieces.stamp(named_fix, width)
+            for point, shift in shifts:
+                if (ground_bits >> shift) & mask == mask:
+                    key = (*named_fix, shift)
+                    self.presence[key] = model.NewBoolVar(f"{named_fix}:{point}")
+                    for cell in cells:
+                        self.pos_items[shift + cell].append(key)
+
+        """
+        When the space is a full rectangle, any solution flipped left-right and/or top-bottom is another solution.
+        So a piece that is used exactly once may as well keep its centre in the low-x, low-y quarter of the space,
+        as one of the flips of every solution puts it there. Centres are doubled so that they stay integers.
+        The piece with fewest lib entries is chosen, as it has the fewest placements left to try.
+        """
+        barred = set()
+        once = [k for k in sorted(pieces.names) if available.get(k) == 1]
+        if once and len(self.ground) == (x2 - x0 + 1) * (y2 - y0 + 1):
+            anchor = min(once, key=lambda k: sum(1 for fix in pieces.lib if fix[0] == k))
+            for (k, i, shift), var in self.presence.items():
+                if k == anchor:
+                    x, y = shift % width, shift // width
+                    fx = max(px for px, _ in pieces.lib[k, i])
+                    fy = max(py for _, py in pieces.lib[k, i])
+                    if 2 * x + fx > x2 - x0 or 2 * y + fy > y2 - y0:
+                        barred.add((k, i, shift))
+                        model.Add(var == 0)
 
         """
-        Compose pos_items - this is the set of all 5 points of each possible piece at each x,y in the space.
-        We will use this for constraint setting and for rendering.
+        With no gaps, and a fixed count of each piece that exactly fills the space, this is an exact cover problem.
         """
-        self.pos_items = {x: set() for x in self.ground}
-        for fixed, p_bv in self.presence.items():
-            pp = placement[fixed]
-            for point in pp:
-                self.pos_items[point].add(fixed)
+        size = sum(allowed * len(pieces.lib.get((k, 0), ())) for k, allowed in available.items())
+        if not self.allow_gaps and all(allowed > 0 for allowed in available.values()) and size == len(self.ground):
+            self.cover([key for key in self.presence if key not in barred], available, [shift for _, shift in shifts])
+            return
+
+        """
+        Small models are solved fastest by one worker, without the cost of starting and sharing between threads.
+        """
+        if 'num_search_workers' not in self.solver_params:
+            placements = len(self.presence)
+            self.solver.parameters.num_search_workers = 1 if placements < 2000 else 8 if placements < 20000 else 16
+
+        """
+        Compose free - the entire set of lib+offset pieces by each 'free' piece (eg, the set of all "K")
+        """
+        free = {k: [bv for i, bv in self.presence.items() if i[0] == k] for k in available}
 
         """
         Constraints are: 
@@ -106,14 +176,23 @@ class PolyominoPuzzleSolver:
         The problem allows to solve with specific numbers of pieces, or to maximise certain pieces.
         For maximising, we use 0 or a -ve number (the -ve will be the minimum for that piece)
         eg. ['F': -2, 'I': 0, 'L': 2, 'N': 2] = Use exactly 2L and 2N maximising F,I with 2+ F and 0+ I.
+        A maximised piece can't be placed more times than it fits into the space left by the least that the other
+        pieces need, which bounds its count. Each maximised piece is worth 'scale' plus its size, so the most pieces
+        always win, with the larger pieces preferred when that is tied. As 'scale' is more than the whole space,
+        the count is the objective // scale.
         """
         to_maximise = []
+        self.scale = len(self.ground) + 1
+        least = {k: abs(allowed) * len(pieces.lib.get((k, 0), ())) for k, allowed in available.items()}
         for k, allowed in available.items():
             if allowed > 0:
                 model.Add(sum(free[k]) == allowed)
             else:
                 model.Add(sum(free[k]) >= -allowed)  # if we want at least 1, use -1
-                to_maximise += free[k]
+                if free[k]:
+                    size = len(pieces.lib[k, 0])
+                    model.Add(sum(free[k]) <= (len(self.ground) - sum(least.values()) + least[k]) // size)
+                    to_maximise += [(self.scale + size) * bv for bv in free[k]]
 
         if to_maximise:
             model.Maximize(sum(to_maximise))
@@ -122,28 +201,116 @@ class PolyominoPuzzleSolver:
         """
         For each xy, constrain the sum of pos_items to 1 (1 piece per x,y).
         """
-        for pt_points in self.pos_items.values():
-            items = [self.presence[i] for i in pt_points]
+        for _, shift in shifts:
+            items = [self.presence[i] for i in self.pos_items[shift]]
             if self.allow_gaps:
                 model.Add(sum(items) <= 1)
             else:
                 model.Add(sum(items) == 1)
 
+        """
+        Branch on the biggest pieces first, as they are the hardest to fit into what is left.
+        The sort is stable, so placements of the same size keep their order.
+        """
+        by_size = sorted(self.presence, key=lambda i: len(pieces.lib[i[:-1]]), reverse=True)
+        model.AddDecisionStrategy(
+            [self.presence[i] for i in by_size], cp_model.CHOOSE_FIRST, cp_model.SELECT_MAX_VALUE
+        )
+
         """
         Can now solve.
         """
         self.status = self.solver.Solve(model)
+        self.wall_time = self.solver.WallTime()
+        if self.status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            self.placed = {key for key, var in self.presence.items() if self.solver.Value(var)}
+
+    def squares(self, key: tuple) -> list:
+        """
+        return the bits of the ground covered by a placement.
+        """
+        return [key[-1] + cell for cell in self.pieces.stamp(key[:-1], self.width)[1]]
+
+    def cover(self, placements: list, available: dict, squares: list):
+        """
+        Knuth's Algorithm X, with each column as a set of rows rather than as dancing links.
+        Each square of the space is a column that must be covered once, and each piece is a column that must be
+        covered as many times as it is available. The rows are the placements, each covering its squares and piece.
+        The search takes the column with fewest rows left, but only from those needed once, so the placements of
+        a piece that is used several times are not tried in every order.
+        """
+        start = time.perf_counter()
+        need = {square: 1 for square in squares}
+        need.update(available)
+        rows = {key: [*self.squares(key), key[0]] for key in placements}
+        columns = {col: set() for col in need}
+        for key, cols in rows.items():
+            for col in cols:
+                columns[col].add(key)
+        try:
+            deadline = start + self.solver.parameters.max_time_in_seconds
+            solution = next(self._exact_cover(columns, rows, need, [], deadline), None)
+            self.status = cp_model.INFEASIBLE if solution is None else cp_model.OPTIMAL
+            self.placed = set(solution or ())
+        except TimeoutError:
+            self.status = cp_model.UNKNOWN
+        self.wall_time = time.perf_counter() - start
+
+    @staticmethod
+    def _exact_cover(columns: dict, rows: dict, need: dict, solution: list, deadline: float):
+        if not columns:
+            yield list(solution)
+            return
+        if time.perf_counter() > deadline:
+            raise TimeoutError
+        if any(len(rs) < need[col] for col, rs in columns.items()):
+            return
+        col = min((c for c in columns if need[c] == 1), key=lambda c: len(columns[c]), default=None)
+        if col is None:
+            return
+        for row in list(columns[col]):
+            solution.append(row)
+            popped = PolyominoPuzzleSolver._select(columns, rows, need, row)
+            yield from PolyominoPuzzleSolver._exact_cover(columns, rows, need, solution, deadline)
+            PolyominoPuzzleSolver._deselect(columns, rows, need, row, popped)
+            solution.pop()
+
+    @staticmethod
+    def _select(columns: dict, rows: dict, need: dict, row) -> list:
+        # Count the row against each of its columns, removing those that are now covered with all their rows.
+        popped = []
+        for col in rows[row]:
+            need[col] -= 1
+            if need[col] == 0:
+                for other in columns[col]:
+                    for c in rows[other]:
+                        if c != col:
+                            columns[c].remove(other)
+                popped.append(columns.pop(col))
+        return popped
+
+    @staticmethod
+    def _deselect(columns: dict, rows: dict, need: dict, row, popped: list):
+        # Undo _select, in reverse.
+        for col in reversed(rows[row]):
+            if need[col] == 0:
+                columns[col] = popped.pop()
+                for other in columns[col]:
+                    for c in rows[other]:
+                        if c != col:
+                            columns[c].add(other)
+            need[col] += 1
 
     def show(self) -> bool:
         if self.status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
             if self.maximising:
-                print(f"Solver places {int(self.solver.ObjectiveValue())} pieces in {self.solver.WallTime()}s")
+                print(f"Solver places {int(self.solver.ObjectiveValue()) // self.scale} pieces in {self.wall_time}s")
             else:
-                print(f"Solved challenge in {self.solver.WallTime()}s")
+                print(f"Solved challenge in {self.wall_time}s")
             return True
         else:
             if self.status == cp_model.INFEASIBLE:
-                print(f"Solver says the challenge is infeasible after {self.solver.WallTime()}s.")
+                print(f"Solver says the challenge is infeasible after {self.wall_time}s.")
             else:
                 print(f"Solver ran out of time.")
             return False
@@ -163,89 +330,90 @@ class PolyominoPuzzleSolver:
         """
         Derive grid size, based upon the min/max x,y values set in the space
         """
-        x1 = min(self.ground, key=lambda a: a[0])[0]
-        y1 = min(self.ground, key=lambda a: a[1])[1]
-        x2 = max(self.ground, key=lambda a: a[0])[0]
-        y2 = max(self.ground, key=lambda a: a[1])[1]
+        pts = np.fromiter((c for pt in self.ground for c in pt), dtype=np.int64).reshape(-1, 2)
+        x1, y1 = pts.min(axis=0).tolist()
+        x2, y2 = pts.max(axis=0).tolist()
 
         """
-        Compose grid dict, based upon solver values
+        Compose grid of piece ids, based upon the pieces placed.
+        Empty squares are -1, and the grid has a border of -2 for outside.
         """
-        grid = {}
-        for y in range(y1, y2 + 1):
-            for x in range(x1, x2 + 1):
-                grid[(x - x1, y - y1)] = None
-                if (x, y) in self.pos_items:
-                    for maybe in self.pos_items[x, y]:
-                        if self.solver.Value(self.presence[maybe]):
-                            grid[(x - x1, y - y1)] = maybe
+        x_dim = x2 + 1 - x1
+        y_dim = y2 + 1 - y1
+        ids = np.full((y_dim + 2, x_dim + 2), -2, dtype=np.int32)
+        bits = np.full(y_dim * self.width, -1, dtype=np.int32)
+        for n, key in enumerate(self.placed):
+            bits[self.squares(key)] = n
+        ids[1:-1, 1:-1] = bits.reshape(y_dim, self.width)[:, :x_dim]
 
         """
-        Draw grid using box drawing characters
+        Draw grid using box drawing characters, one pair for each corner.
+        The walls of a corner are wherever the squares to either side of it differ.
         """
-        x_dim = x2 + 1 - x1
-        y_dim = y2 + 1 - y1
-        for y in range(y_dim + 1):
-            line = ""
-            for x in range(x_dim + 1):
-                nw = grid[(x - 1, y - 1)] if 0 <= y - 1 < y_dim and 0 <= x - 1 < x_dim else '~'
-                ne = grid[(x - 0, y - 1)] if 0 <= y - 1 < y_dim and 0 <= x - 0 < x_dim else '~'
-                sw = grid[(x - 1, y - 0)] if 0 <= y - 0 < y_dim and 0 <= x - 1 < x_dim else '~'
-                se = grid[(x - 0, y - 0)] if 0 <= y - 0 < y_dim and 0 <= x - 0 < x_dim else '~'
-                line += self.box(nw != sw, ne != se, nw != ne, sw != se) + self.box(ne != se, ne != se, False, False)
-            print(line)
+        nw, ne, sw, se = ids[:-1, :-1], ids[:-1, 1:], ids[1:, :-1], ids[1:, 1:]
+        chars = np.array([self.box(*(value >> i & 1 for i in range(4))) for value in range(16)])
+        lines = np.empty((y_dim + 1, 2 * (x_dim + 1)), dtype=chars.dtype)
+        lines[:, 0::2] = chars[(nw != sw) | (ne != se) << 1 | (nw != ne) << 2 | (sw != se) << 3]
+        lines[:, 1::2] = chars[(ne != se) * 3]
+        for line in lines:
+            print(''.join(line))
 
 class ShapeCollection:
     """
      A set of shapes of solid squares
     """
+    # The fixes of each shape, keyed by its points: found once, and shared by every collection in this process.
+    fixes = {}
+
     def __init__(self, points):
         self.lib = {}
+        self.stamps = {}
         self.names = set(points.keys())
         self.fix(points)
 
     @staticmethod
-    def _normalise_pts_(d: list):
-        # calculate the boundary and the size of each dimension for a shape
-        lx, bx = min(x[0] for x in d), 1 + max(x[0] for x in d)
-        ly, by = min(x[1] for x in d), 1 + max(x[1] for x in d)
-        grid = [[[x, y] in d for y in range(ly, by)] for x in range(lx, bx)]
-        res = [[x, y] for x in range(bx-lx) for y in range(by-ly) if grid[x][y]]
-        return res
-
-    def legal(self, key: tuple, ground: set, offs: tuple) -> bool:
-        """
-        Given an (x,y) offset, and a 'space' of legal points check to see if this pentomino can
-        be legally placed in it.
-        """
-        point_set = self.lib[key]
-        for pt in point_set:
-            xy = pt[0] + offs[0], pt[1] + offs[1]
-            if xy not in ground:
-                return False
-        return True
+    def _normalise_pts_(d) -> np.ndarray:
+        # bring a shape to the origin, as a sorted (n, 2) array of its distinct points.
+        pts = np.asarray(d, dtype=np.int8)
+        return np.unique(pts - pts.min(axis=0), axis=0)
 
-    def translate(self, key: tuple, offs: tuple) -> set:
+    def stamp(self, key: tuple, width: int) -> tuple:
         """
-            return the normalised pentomino translated by offset (x,y).
+        return the pentomino as a bitmask, with each row of it 'width' bits apart, along with the bits it sets.
+        These are kept, as the same width is used for every point of a space.
         """
-        return {tuple((pt[0] + offs[0], pt[1] + offs[1])) for pt in self.lib[key]}
+        if (key, width) not in self.stamps:
+            cells = tuple(y * width + x for x, y in self.lib[key])
+            self.stamps[key, width] = sum(1 << cell for cell in cells), cells
+        return self.stamps[key, width]
+
+    # symmetry group: 8 2D rotations constrained by sequences of 90-degree rotations and reflections.
+    # As matrices acting on row vectors, taking [a, b] to:
+    # [+a, +b], [-b, +a], [-a, -b], [+b, -a], [+b, +a], [-a, +b], [-b, -a], [+a, -b]
+    square_group = np.array([
+        [[1, 0], [0, 1]], [[0, 1], [-1, 0]], [[-1, 0], [0, -1]], [[0, -1], [1, 0]],
+        [[0, 1], [1, 0]], [[-1, 0], [0, 1]], [[0, -1], [-1, 0]], [[1, 0], [0, -1]]
+    ], dtype=np.int8)
 
     @staticmethod
-    def _square_p(pts, p=0):
-        # symmetry group: 8 2D rotations constrained by sequences of 90-degree rotations and reflections
-        return [[[+a, +b], [-b, +a], [-a, -b], [+b, -a], [+b, +a], [-a, +b], [-b, -a], [+a, -b]][p % 8] for a, b in pts]
+    def _square_p(pts: np.ndarray, p=0) -> np.ndarray:
+        return pts @ ShapeCollection.square_group[p % 8]
 
     def fix(self, points: dict):
+        # The fixes only depend on the points, so they are only found once for each shape.
+        fixes = ShapeCollection.fixes
         for k, pts in points.items():
-            # Try all 8 2D rotations on a shape and eliminate symmetric identities by using a hash of the result.
-            restrict = dict()
-            base = ShapeCollection._normalise_pts_(pts)
-            for f in range(8):
-                fix = ShapeCollection._normalise_pts_(ShapeCollection._square_p(base, f))
-                fix_str = str(fix)
-                restrict[hash(fix_str)] = fix
-            for i, fix in enumerate(restrict.values()):
+            code = tuple(sorted(tuple(pt) for pt in pts))
+            if code not in fixes:
+                # Try all 8 2D rotations on a shape and eliminate symmetric identities by using the bytes of the result.
+                restrict = dict()
+                base = ShapeCollection._normalise_pts_(pts)
+                for f in range(8):
+                    fix = ShapeCollection._normalise_pts_(ShapeCollection._square_p(base, f))
+                    restrict.setdefault(fix.tobytes(), fix)
+                # Each fix is kept as a tuple of (x, y) tuples, which is all that stamp needs.
+                fixes[code] = [tuple(map(tuple, fix.tolist())) for fix in restrict.values()]
+            for i, fix in enumerate(fixes[code]):
                 self.lib[(k, i)] = fix
 
 class PentominoSet(ShapeCollection):
@@ -257,7 +425,7 @@ class PentominoSet(ShapeCollection):
      Each pentomino has a name that loosely represents it's shape.
 
      Here each pentomino is defined on a 5x5 grid, centred at 2,2, with co-ordinates 0..4 in x and y
-     the transform/translate methods both move the centre to 0,0 as required.
+     the fixes are normalised, which moves each one to 0,0 as required.
     """
     def __init__(self):
         pentominoes = {
@@ -276,9 +444,7 @@ class PentominoSet(ShapeCollection):
         }
         super().__init__(pentominoes)
 
-def example(space_set):
-    shapes = PentominoSet()
-    solver = PolyominoPuzzleSolver()
+def example(solver, shapes, space_set):
     challenge = {
         'gaps': False,
         'fill': space_set,
@@ -293,9 +459,11 @@ if __name__ == '__main__':
     # commonly used spaces in pentomino problems.
     spaces = [(12, 5), (10, 6), (15, 4), (20, 3)]
     special = set((x, y) for y in range(0, 8) for x in range(0, 8)) - {(3, 3), (3, 4), (4, 3), (4, 4)}
+    pentominoes = PentominoSet()
+    puzzle_solver = PolyominoPuzzleSolver()
     for sx, sy in spaces:
         space = set((x, y) for y in range(sy) for x in range(sx))
-        example(space)
-    example(special)
+        example(puzzle_solver, pentominoes, space)
+    example(puzzle_solver, pentominoes, special)
 
 
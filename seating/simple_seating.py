@@ -85,7 +85,7 @@ def create_data_model(data_model_file: str):
         sum([data['org_sess_sum'][o_idx][s_idx] for o_idx in data['org_sess_sum']]) for s_idx in range(sessions)
     ]
     data['orgs_sum'] = len(data['orgs'])
-    data['delegates_sum'] = sum([len(d.idx()) for d in data['orgs'].values()])
+    data['delegates_sum'] = sum([len(d.keys()) for d in data['orgs'].values()])
     choke_point = max(data['sess_sum'])
     if choke_point > data['seats_sum']:
         busy = [data['sessions'][i] for i, x in enumerate(data['sess_sum']) if x == choke_point]
@@ -93,7 +93,7 @@ def create_data_model(data_model_file: str):
         exit(0)
     return data
 
-def store_allocation(data, or_vars, solver):
+def store_allocation(data, seat_delegates, solver):
     data['result'] = {}
     for s_idx, s_name in enumerate(data['sessions']):
         data['result'][s_name] = {}
@@ -101,11 +101,10 @@ def store_allocation(data, or_vars, solver):
             data['result'][s_name][row] = []
             for c_idx in range(data['rows'][row]):
                 chair = None
-                for o_idx, o_name in enumerate(data['orgs'].idx()):
-                    for d_idx, d_name in enumerate(data['orgs'][o_name].idx()):
-                        if data['orgs'][o_name][d_name][s_idx] == 1 and \
-                                solver.Value(or_vars[(d_idx, o_idx, s_idx, r_idx, c_idx)]) > 0:
-                            chair = d_name
+                for d_name, var in seat_delegates.get((s_idx, r_idx, c_idx), ()):
+                    if solver.Value(var):
+                        chair = d_name
+                        break
                 data['result'][s_name][row].append(chair)
 
 
@@ -118,6 +117,8 @@ def allocate(data):
 
     del_chairs = {}
     org_chairs = {}
+    # The (delegate name, chair variable) pairs for each (session, row, column), gathered as they are made.
+    seat_delegates = {}
 
     # bool var for each legal seat for each delegate and for each organisation..
     for o_idx, o_name in enumerate(data['orgs']):
@@ -134,6 +135,7 @@ def allocate(data):
                             if o_tuple not in org_chairs:
                                 org_chairs[o_tuple] = model.NewBoolVar(f'{o_idx}.{s_idx}.{r_idx}.{c_idx}')
                             del_chairs[d_tuple] = model.NewBoolVar(f'{d_idx}.{o_idx}.{s_idx}.{r_idx}.{c_idx}')
+                            seat_delegates.setdefault((s_idx, r_idx, c_idx), []).append((del_n, del_chairs[d_tuple]))
                             # Every delegate belongs to their organisation
                             model.AddImplication(del_chairs[d_tuple], org_chairs[o_tuple])
                             # Each delegate is assigned to exactly one chair in each session.
@@ -143,42 +145,45 @@ def allocate(data):
                                 model.Add(del_chairs[d_tuple] == del_chairs[d_early])
                     if len(one_chair_constraint) > 0:
                         model.Add(sum(one_chair_constraint) == 1)
+    # The block starts of each (organisation, session), with the organisation's size there.
+    org_starts = []
     # sum(sum(j for j in i) for i in a)
     # each organisation must be sat and requires adjacent seats.
     for o_idx, o_name in enumerate(data['orgs']):
         for s_idx, s_name in enumerate(data['sessions']):
-            # All seats must be filled by organisation.
-            chair_list = []
-            for r_idx, r_name in enumerate(data['rows']):
-                for c_idx in range(data['rows'][r_name]):
-                    o_tuple = o_idx, s_idx, r_idx, c_idx
-                    if o_tuple in org_chairs:
-                        chair_list.append(org_chairs[o_tuple])
-            if chair_list:
-                model.Add(sum(chair_list) == data['org_sess_sum'][o_name][s_idx])
-
             # Organisations must be sat together.
-            adjacency_constraint = []
+            # Seats are numbered through the rows in order, and the organisation's block starts at exactly one seat
+            # from which it fits in what is left of its row. A chair is the organisation's if, and only if,
+            # the block starts at one of the 'size' seats up to and including it.
+            # So the organisation has exactly 'size' chairs, which its delegates fill.
+            size = data['org_sess_sum'][o_name][s_idx]
+            if size == 0:
+                continue
+            starts = {}
+            seat = 0
+            for r_idx, r_name in enumerate(data['rows']):
+                for c_idx in range(data['rows'][r_name] - size + 1):
+                    starts[seat + c_idx] = model.NewBoolVar(f'{o_idx}.{s_idx}.{r_idx}.{c_idx}^')
+                seat += data['rows'][r_name]
+            model.AddExactlyOne(starts.values())
+            org_starts.append((size, list(starts.values())))
+            seat = 0
             for r_idx, r_name in enumerate(data['rows']):
-                for c_idx in range(data['rows'][r_name] - data['org_sess_sum'][o_name][s_idx] + 1):
-                    tmp = model.NewBoolVar('')
-                    adjacency_constraint.append(tmp)
-                    model.AddBoolAnd(
-                        org_chairs[o_idx, s_idx, r_idx, c_idx + i]
-                        for i in range(data['org_sess_sum'][o_name][s_idx])
-                    ).OnlyEnforceIf(tmp)
-            model.AddBoolOr(adjacency_constraint)
+                for c_idx in range(data['rows'][r_name]):
+                    covering = [starts[i] for i in range(seat - size + 1, seat + 1) if i in starts]
+                    model.Add(org_chairs[o_idx, s_idx, r_idx, c_idx] == sum(covering))
+                    seat += 1
+
+    # Place the bigger organisations first, as they are the hardest to fit into what is left of the rows.
+    org_starts.sort(key=lambda item: item[0], reverse=True)
+    model.AddDecisionStrategy(
+        [start for _, starts in org_starts for start in starts], cp_model.CHOOSE_FIRST, cp_model.SELECT_MAX_VALUE
+    )
 
     # Each chair can only sit up to one delegate per session..
-    for s_idx, s_name in enumerate(data['sessions']):
-        for r_idx, r_name in enumerate(data['rows']):
-            for c_idx in range(data['rows'][r_name]):
-                chair_list = []
-                for dc in del_chairs.keys():
-                    if dc[2] == s_idx and dc[3] == r_idx and dc[4] == c_idx:
-                        chair_list.append(del_chairs[dc])
-                if chair_list:
-                    model.Add(sum(chair_list) <= 1)
+    for delegates in seat_delegates.values():
+        if len(delegates) > 1:
+            model.Add(sum(var for _, var in delegates) <= 1)
 
     org_count = data['orgs_sum']
     del_count = data['delegates_sum']
@@ -194,7 +199,7 @@ def allocate(data):
     )
     status = solver.Solve(model)
     if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
-        store_allocation(data, del_chairs, solver)
+        store_allocation(data, seat_delegates, solver)
     else:
         print(f'allocate failed\n', solver.ResponseStats())
 
@@ -94,7 +94,8 @@
 """
 
 import json
-from random import choices
+from concurrent.futures import ProcessPoolExecutor
+from random import randint
 from ortools.sat.python import cp_model
 
 # Adjust this to the number of cores you want to allocate.
@@ -135,7 +136,6 @@ def solve_row_tranches(data, tranche_seats: int, row_slack: int):
     # tranche_seats. It's also important that we use all rows available.
     # calculate the number of adjusted rows by giving each adj.row tranche_seats seats.
     model = cp_model.CpModel()
-    basis = {}
 
     optimum_seats = tranche_seats - row_slack
     all_rows_list = [data['rows'][row] for r_idx, row in enumerate(data['rows'])]
@@ -147,12 +147,14 @@ def solve_row_tranches(data, tranche_seats: int, row_slack: int):
     max_row_seats = max(all_rows_list)
     maximum_seats = max(max_row_seats, tranche_seats + 1)
 
+    basis = {}
     for t_idx in t_range:
         for r_idx in r_range:
             basis[r_idx, t_idx] = model.NewBoolVar(f'{r_idx}.{t_idx}')
 
-    for r_idx in range(len(all_rows_list)):
-        model.Add(sum(basis[r_idx, t_idx] for t_idx in t_range) <= 1)
+    # Each row is in at most one tranche.
+    for r_idx in r_range:
+        model.AddAtMostOne(basis[r_idx, t_idx] for t_idx in t_range)
 
     slacks = [model.NewBoolVar(f's{t_idx}') for t_idx in t_range]
     oflows = [model.NewBoolVar(f'o{t_idx}') for t_idx in t_range]
@@ -160,15 +162,20 @@ def solve_row_tranches(data, tranche_seats: int, row_slack: int):
     value = []
     for t_idx in t_range:
         value.append(model.NewIntVar(0, maximum_seats, f'v{t_idx}'))
-        model.Add(value[t_idx] == sum([basis[r_idx, t_idx] * all_rows_list[r_idx] for r_idx in r_range]))
+        model.Add(value[t_idx] == cp_model.LinearExpr.WeightedSum(
+            [basis[r_idx, t_idx] for r_idx in r_range], all_rows_list
+        ))
         model.Add(value[t_idx] <= optimum_seats).OnlyEnforceIf(slacks[t_idx])
         model.Add(value[t_idx] > optimum_seats).OnlyEnforceIf(slacks[t_idx].Not())
         model.Add(value[t_idx] <= tranche_seats).OnlyEnforceIf(oflows[t_idx])
         model.Add(value[t_idx] > tranche_seats).OnlyEnforceIf(oflows[t_idx].Not())
-        model.Add(value[t_idx] <= maximum_seats)
 
+    # Rows of equal length, and the tranches themselves, are interchangeable; but symmetry breaking them
+    # (or equal organisations in solve_tranche_orgs) doesn't pay here. Every packing that uses all the rows is
+    # optimal, so ordering them only changes which packing is found, and fewer of those leave enough room for
+    # solve_tranche_orgs; while ordering the organisations slows that solve down.
     # Maximize total value of packed items.
-    model.Maximize(sum(value))
+    model.Maximize(cp_model.LinearExpr.Sum(value))
     solver = cp_model.CpSolver()
     solver.parameters.num_search_workers = workers
     status = solver.Solve(model)
@@ -193,7 +200,7 @@ def store_tranche_orgs(data, solver, basis):
         for s_idx in s_range:
             data['tranche_org_seats'][t_idx].append(0)
             for o_idx in o_range:
-                if solver.Value(basis[t_idx, o_idx]) > 0:
+                if (t_idx, o_idx) in basis and solver.Value(basis[t_idx, o_idx]) > 0:
                     org = org_names[o_idx]
                     data['tranche_org_seats'][t_idx][s_idx] += data['org_sess_sum'][org][s_idx]
                     if org not in data['tranche_orgs'][t_idx]:
@@ -213,8 +220,11 @@ def solve_tranche_orgs(data, row_slack: int, row_force: int):
     # t_range: range over 'bins (tranches)' of different capacities.
     t_range = range(len(data['seat_tranches']))  # [48, 44, 48, 48, 44, 46]
 
-    # o_range: range over organisations/objects, with their volume-per-session
-    o_range = range(len(data['org_sess_sum']))  # {'AD': [3, 2, 1, 3, 3], 'AE': [1, 3, 4, 1, 2], ... }
+    # active_orgs: the organisations/objects, with their volume-per-session
+    # Organisations without any delegates have nothing to sit, so they are left out.
+    active_orgs = [  # {'AD': [3, 2, 1, 3, 3], 'AE': [1, 3, 4, 1, 2], ... }
+        (o_idx, org) for o_idx, org in enumerate(data['org_sess_sum']) if data['org_active'][org]
+    ]
 
     # s_range range over time points (sessions) (org-volume changes at each point).
     # this could also be derived by len(data['org_sess_sum'][0])
@@ -226,42 +236,42 @@ def solve_tranche_orgs(data, row_slack: int, row_force: int):
     # each org can be in a given tranche (across all sessions)
     basis = {}
     for t_idx in t_range:
-        for o_idx in o_range:
+        for o_idx, org in active_orgs:
             basis[t_idx, o_idx] = model.NewBoolVar(f'o{t_idx}.{o_idx}')
 
     for t_idx in t_range:  # In this tranche..
         for s_idx in s_range:  # In each session
-            model.Add(  # ... ensure that...
-                row_force + sum(  # there are always row_forced seats for allocation...
-                    basis[t_idx, o_idx] * data['org_sess_sum'][org][s_idx] for o_idx, org in
-                    enumerate(data['org_sess_sum'])  # ... all the organisation chair allocations is ...
-                ) <= (data['seat_tranches'][t_idx])  # <= the seats made available to this tranche.
+            model.AddLinearConstraint(  # ... ensure that...
+                cp_model.LinearExpr.WeightedSum(  # ... all the organisation chair allocations are between...
+                    [basis[t_idx, o_idx] for o_idx, org in active_orgs],
+                    [data['org_sess_sum'][org][s_idx] for o_idx, org in active_orgs]
+                ),
+                0,  # ... none and the seats made available to this tranche,
+                data['seat_tranches'][t_idx] - row_force  # leaving row_forced seats for allocation.
             )
 
     # each organisation must be sat just once.
-    for o_idx, org in enumerate(data['org_sess_sum']):  # for each organisation...
-        if sum(data['org_sess_sum'][org]) > 0:
-            model.Add(sum([basis[t_idx, o_idx] for t_idx in t_range]) == 1)
-        else:
-            model.Add(sum([basis[t_idx, o_idx] for t_idx in t_range]) == 0)
+    for o_idx, org in active_orgs:  # for each organisation...
+        model.AddExactlyOne(basis[t_idx, o_idx] for t_idx in t_range)
 
     s_values = [model.NewIntVar(0, data['sess_sum'][s_idx], f's{s_idx}') for s_idx in s_range]
     for s_idx in s_range:
-        model.Add(s_values[s_idx] == sum(
-            basis[t_idx, o_idx] * data['org_sess_sum'][org][s_idx]
-            for o_idx, org in enumerate(data['org_sess_sum'])
-            for t_idx in t_range
+        model.Add(s_values[s_idx] == cp_model.LinearExpr.WeightedSum(
+            [basis[t_idx, o_idx] for o_idx, org in active_orgs for t_idx in t_range],
+            [data['org_sess_sum'][org][s_idx] for o_idx, org in active_orgs for t_idx in t_range]
         ))
 
     slacks = [model.NewBoolVar('w_%i' % t_idx) for t_idx in t_range]
     t_values = [model.NewIntVar(0, data['seat_tranches'][t_idx], f't{t_idx}') for t_idx in t_range]
     for t_idx in t_range:
-        model.Add(t_values[t_idx] == sum(basis[t_idx, o_idx] for o_idx in o_range))
+        model.Add(t_values[t_idx] == cp_model.LinearExpr.Sum([basis[t_idx, o_idx] for o_idx, org in active_orgs]))
         optimum_seats = data['seat_tranches'][t_idx] - row_slack
         model.Add(t_values[t_idx] <= optimum_seats).OnlyEnforceIf(slacks[t_idx])
         model.Add(t_values[t_idx] > optimum_seats).OnlyEnforceIf(slacks[t_idx].Not())
 
-    model.Maximize(sum(s_values))
+    # A first-fit decreasing packing of the organisations isn't worth hinting here: with row_force taken off
+    # the tranches it can't find room for every organisation, and repairing it slows the solve down.
+    model.Maximize(cp_model.LinearExpr.Sum(s_values))
     solver = cp_model.CpSolver()
     solver.parameters.num_search_workers = workers
     status = solver.Solve(model)
@@ -306,23 +316,22 @@ def create_data_model(data_model_file: str, seats_per_tranche: int = 60, row_sla
                 del_n = org_n + str(d_idx).zfill(3)
                 data['orgs'][org_n][del_n] = orgs[org][delegate]
                 # Now populate delegate sessions if they are not set.
+                # Each of the 2**sessions - 1 requests with at least one session is equally likely.
                 if not orgs[org][delegate]:
-                    session_request = [0]
-                    while sum(session_request) == 0:
-                        session_request = choices([0, 1], k=sessions)
-                    data['orgs'][org_n][del_n] = session_request
+                    bits = randint(1, (1 << sessions) - 1)
+                    data['orgs'][org_n][del_n] = [(bits >> s_idx) & 1 for s_idx in range(sessions)]
         # Now save the new model
         with open('data_model.json', 'w') as outfile:
             json.dump(data, outfile, sort_keys=True)
 
     data['seats_sum'] = sum(data['seat_tranches'])
+    # zip(*...) turns the delegates' session requests into one tuple per session, to be summed.
     data['org_sess_sum'] = {
-        org: [
-            sum([person[session] for person in data['orgs'][org].values()]) for session in range(sessions)
-        ] for o_idx, org in enumerate(data['orgs'])}
-    data['sess_sum'] = [
-        sum([data['org_sess_sum'][o_idx][s_idx] for o_idx in data['org_sess_sum']]) for s_idx in range(sessions)
-    ]
+        org: [sum(session) for session in zip(*delegates.values())] if delegates else [0] * sessions
+        for org, delegates in data['orgs'].items()
+    }
+    data['sess_sum'] = [sum(session) for session in zip(*data['org_sess_sum'].values())] or [0] * sessions
+    data['org_active'] = {org: any(data['org_sess_sum'][org]) for org in data['org_sess_sum']}
     if max(data['sess_sum']) > data['seats_sum']:
         print("Not enough seats (", str(data['seats_sum']), ") for the session requests (", max(data['sess_sum']), ")")
         exit(0)
@@ -332,46 +341,73 @@ def create_data_model(data_model_file: str, seats_per_tranche: int = 60, row_sla
 
 
 def store_allocation(data, or_vars, tranche):
-    data['result'] = {}
-    for s_idx, s_name in enumerate(data['sessions']):
-        data['result'][s_name] = {}
-        for r_idx, row in enumerate(data['rows']):
-            data['result'][s_name][row] = []
-            for c_idx in range(data['rows'][row]):
-                chair = None
-                for o_idx, o_name in enumerate(data['orgs'].keys()):
-                    for d_idx, d_name in enumerate(data['orgs'][o_name].keys()):
-                        if data['orgs'][o_name][d_name][s_idx] == 1 and \
-                                tranche.Value(or_vars[(d_idx, o_idx, s_idx, r_idx, c_idx)]) > 0:
-                            chair = d_name
-                data['result'][s_name][row].append(chair)
-
-
-def allocate(data, tranche_idx):
+    # Every chair starts empty, then each delegate chair variable that is set puts its delegate into its chair.
+    # The solution's values are fetched once, and read by each variable's index.
+    sessions = list(data['sessions'])
+    rows = list(data['rows'])
+    delegate_names = [list(data['orgs'][o_name]) for o_name in data['orgs']]
+    data['result'] = {s_name: {row: [None] * data['rows'][row] for row in rows} for s_name in sessions}
+    solution = tranche.ResponseProto().solution
+    for (d_idx, o_idx, s_idx, r_idx, c_idx), var in or_vars.items():
+        if solution[var.Index()] > 0:
+            data['result'][sessions[s_idx]][rows[r_idx]][c_idx] = delegate_names[o_idx][d_idx]
+
+
+def allocate(data, tranche_idx, search_workers: int, **solver_params):
     print(f"calculating seating allocation #{tranche_idx}...")
     model = cp_model.CpModel()
     solver = cp_model.CpSolver()
-    solver.parameters.num_search_workers = workers
+    solver.parameters.num_search_workers = search_workers
     solver.parameters.max_time_in_seconds = 60
+    # Any solver_params (eg. linearization_level=0, cp_model_probing_level=1) are set last, to tune big allocations.
+    for name, value in solver_params.items():
+        setattr(solver.parameters, name, value)
 
     del_chairs = {}
     org_chairs = {}
+    # The delegate chair variables for each (session, row, column), gathered as they are made.
+    seat_chairs = {}
+    # Looked up once here, rather than in every pass of the loops below.
+    s_range = range(len(data['sessions']))
+    rows = list(data['rows'].items())
+    orgs = list(data['orgs'].items())
+    org_sess_sum = data['org_sess_sum']
 
-    # bool var for each legal seat for each delegate and for each organisation..
-    for o_idx, o_name in enumerate(data['orgs']):
-        del_sessions = data['orgs'][o_name]
-        for d_idx, del_n in enumerate(del_sessions):
-            for s_idx, s_name in enumerate(data['sessions']):
-                if del_sessions[del_n][s_idx] == 1:
+    # bool var for each seat of each organisation, in each session it has delegates, in the rows that can seat it..
+    for o_idx in range(len(orgs)):
+        for s_idx in s_range:
+            size = org_sess_sum[o_idx][s_idx]
+            if size == 0:
+                continue
+            for r_idx, (r_name, row_len) in enumerate(rows):
+                if row_len >= size:
+                    for c_idx in range(row_len):
+                        org_chairs[o_idx, s_idx, r_idx, c_idx] = model.NewBoolVar(f'{o_idx}.{s_idx}.{r_idx}.{c_idx}')
+
+    # bool var for each legal seat for each delegate..
+    for o_idx, (o_name, del_sessions) in enumerate(orgs):
+        for d_idx, attendance in enumerate(del_sessions.values()):
+            # A delegate keeps their chair through consecutive sessions, so it can only be in a row that
+            # seats their whole organisation in each of them. fit is the shortest row for each session.
+            fit = [org_sess_sum[o_idx][s_idx] if attendance[s_idx] == 1 else 0 for s_idx in s_range]
+            for s_idx in s_range[1:]:
+                if attendance[s_idx] == 1 and attendance[s_idx - 1] == 1:
+                    fit[s_idx] = max(fit[s_idx], fit[s_idx - 1])
+            for s_idx in reversed(s_range[:-1]):
+                if attendance[s_idx] == 1 and attendance[s_idx + 1] == 1:
+                    fit[s_idx] = max(fit[s_idx], fit[s_idx + 1])
+            for s_idx in s_range:
+                if attendance[s_idx] == 1:
                     one_chair_constraint = []
-                    for r_idx, r_name in enumerate(data['rows']):
-                        for c_idx in range(data['rows'][r_name]):
+                    for r_idx, (r_name, row_len) in enumerate(rows):
+                        if row_len < fit[s_idx]:
+                            continue
+                        for c_idx in range(row_len):
                             o_tuple = o_idx, s_idx, r_idx, c_idx
                             d_tuple = d_idx, o_idx, s_idx, r_idx, c_idx
                             d_early = d_idx, o_idx, s_idx - 1, r_idx, c_idx
-                            if o_tuple not in org_chairs:
-                                org_chairs[o_tuple] = model.NewBoolVar(f'{o_idx}.{s_idx}.{r_idx}.{c_idx}')
                             del_chairs[d_tuple] = model.NewBoolVar(f'{d_idx}.{o_idx}.{s_idx}.{r_idx}.{c_idx}')
+                            seat_chairs.setdefault((s_idx, r_idx, c_idx), []).append(del_chairs[d_tuple])
                             # Every delegate belongs to their organisation
                             model.AddImplication(del_chairs[d_tuple], org_chairs[o_tuple])
                             # Each delegate is assigned to exactly one chair in each session.
@@ -379,44 +415,42 @@ def allocate(data, tranche_idx):
                             # If the delegate sat in the previous session, they must sit in the same place they sat
                             if d_early in del_chairs:
                                 model.Add(del_chairs[d_tuple] == del_chairs[d_early])
-                    if len(one_chair_constraint) > 0:
-                        model.Add(sum(one_chair_constraint) == 1)
+                    # (If there is no row long enough, this leaves the model infeasible, as it should.)
+                    model.AddExactlyOne(one_chair_constraint)
     # sum(sum(j for j in i) for i in a)
     # each organisation must be sat and requires adjacent seats.
-    for o_idx, o_name in enumerate(data['orgs']):
-        for s_idx, s_name in enumerate(data['sessions']):
+    for o_idx in range(len(orgs)):
+        for s_idx in s_range:
+            size = org_sess_sum[o_idx][s_idx]
             # All seats must be filled by organisation.
             chair_list = []
-            for r_idx, r_name in enumerate(data['rows']):
-                for c_idx in range(data['rows'][r_name]):
+            for r_idx, (r_name, row_len) in enumerate(rows):
+                for c_idx in range(row_len):
                     o_tuple = o_idx, s_idx, r_idx, c_idx
                     if o_tuple in org_chairs:
                         chair_list.append(org_chairs[o_tuple])
             if chair_list:
-                model.Add(sum(chair_list) == data['org_sess_sum'][o_idx][s_idx])
+                model.Add(cp_model.LinearExpr.Sum(chair_list) == size)
+            # A single delegate is always sat together.
+            if size <= 1:
+                continue
 
             # Organisations must be sat together.
             adjacency_constraint = []
-            for r_idx, r_name in enumerate(data['rows']):
-                for c_idx in range(data['rows'][r_name] - data['org_sess_sum'][o_idx][s_idx] + 1):
+            for r_idx, (r_name, row_len) in enumerate(rows):
+                for c_idx in range(row_len - size + 1):
                     tmp = model.NewBoolVar('')
                     adjacency_constraint.append(tmp)
-                    model.AddBoolAnd(
-                        org_chairs[o_idx, s_idx, r_idx, c_idx + i]
-                        for i in range(data['org_sess_sum'][o_idx][s_idx])
-                    ).OnlyEnforceIf(tmp)
+                    window = [org_chairs[o_idx, s_idx, r_idx, c_idx + i] for i in range(size)]
+                    # tmp is true if, and only if, the organisation has every chair in the window.
+                    model.AddBoolAnd(window).OnlyEnforceIf(tmp)
+                    model.AddBoolOr([tmp] + [chair.Not() for chair in window])
             model.AddBoolOr(adjacency_constraint)
 
     # Each chair can only sit up to one delegate per session..
-    for s_idx, s_name in enumerate(data['sessions']):
-        for r_idx, r_name in enumerate(data['rows']):
-            for c_idx in range(data['rows'][r_name]):
-                chair_list = []
-                for dc in del_chairs.keys():
-                    if dc[2] == s_idx and dc[3] == r_idx and dc[4] == c_idx:
-                        chair_list.append(del_chairs[dc])
-                if chair_list:
-                    model.Add(sum(chair_list) <= 1)
+    for chair_list in seat_chairs.values():
+        if len(chair_list) > 1:
+            model.AddAtMostOne(chair_list)
 
     status = solver.Solve(model)
     if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
@@ -425,10 +459,18 @@ def allocate(data, tranche_idx):
         print(f'allocate {tranche_idx} failed\n', solver.ResponseStats())
 
 
-def store_tranche(data, tranche_data):
-    if 'result' in tranche_data:
+def allocate_tranche(tranche_data, tranche_idx, search_workers: int, **solver_params):
+    # This runs in its own process, so only the tranche's result (if it was solved) is handed back to be stored;
+    # the tranche's delegates and rows stay behind.
+    allocate(tranche_data, tranche_idx, search_workers, **solver_params)
+    return tranche_data.get('result')
+
+
+def store_tranche(data, result):
+    # The result's row allocations are shared into the results, not copied.
+    if result:
         for session in data['sessions']:
-            for row, allocation in tranche_data['result'][session].items():
+            for row, allocation in result[session].items():
                 data['results'][session][row] = allocation
 
 
@@ -444,7 +486,7 @@ def print_solution(data):
             rows_str = rows_str + row_str + "| "
         print(session_name + ':', rows_str)
     with open('result.json', 'w') as outfile:
-        json.dump(data['results'], outfile, sort_keys=True)
+        json.dump(data['results'], outfile, sort_keys=True, separators=(',', ':'))
 
 
 def main():
@@ -457,13 +499,16 @@ def main():
     data = create_data_model("data_model.json", 60, 15, 5)
     tranches = data['tranche_count']
     print(f"solving seating for {tranches} tranches.")
+    tranche_list = []
+    row_sets = [set(row_tranche) for row_tranche in data['row_tranches']]
+    org_sets = [set(tranche_org) for tranche_org in data['tranche_orgs']]
     for tranche_idx in range(tranches):
+        tranche_orgs = [org for org in data['orgs'] if org in org_sets[tranche_idx]]
         tranche_data = {
             'sessions': data['sessions'],
-            'rows': {row: data['rows'][row] for row in data['rows'] if row in data['row_tranches'][tranche_idx]},
-            'orgs': {org: data['orgs'][org] for org in data['orgs'] if org in data['tranche_orgs'][tranche_idx]},
-            'org_sess_sum':
-                [data['org_sess_sum'][org] for org in data['orgs'] if org in data['tranche_orgs'][tranche_idx]],
+            'rows': {row: data['rows'][row] for row in data['rows'] if row in row_sets[tranche_idx]},
+            'orgs': {org: data['orgs'][org] for org in tranche_orgs},
+            'org_sess_sum': [data['org_sess_sum'][org] for org in tranche_orgs],
          }
         tranche_data['sess_sum'] = [
             sum(org[s_id] for org in tranche_data['org_sess_sum']) for s_id in range(len(data['sessions']))
@@ -471,9 +516,19 @@ def main():
         # with open('data_model_' + str(tranche_idx) + '.json', 'w') as outfile:
         #     json.dump(tranche_data, outfile, sort_keys=True)
 
-        # Now allocate seats!
-        allocate(tranche_data, tranche_idx)
-        store_tranche(data, tranche_data)
+        tranche_list.append(tranche_data)
+
+    # Now allocate seats!
+    # The tranches are independent, so they are solved side by side, sharing out the workers between them.
+    processes = min(tranches, max(1, workers // 2))
+    search_workers = max(1, workers // processes)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(allocate_tranche, tranche_data, tranche_idx, search_workers)
+            for tranche_idx, tranche_data in enumerate(tranche_list)
+        ]
+        for future in futures:
+            store_tranche(data, future.result())
     print_solution(data)
 
 